@@ -0,0 +1,88 @@
+""" Microbenchmark of the pixmap -> tesseract handoff in the OCR loop.
+
+Compares, per page:
+  png - pix.tobytes() PNG encode, Image.open decode and pytesseract's temp file (the original path)
+  raw - raw pixmap samples streamed to tesseract's stdin as PNM (ExtractPdf(ocr_handoff="raw"))
+  raw-gray - the raw path rendering in grayscale
+
+Each path runs in its own process so peak RSS is measured independently.
+With --handoff-only tesseract isn't run, only the render + image preparation each path does before it.
+
+Usage: python benchmarks/ocr_handoff.py Client1.pdf --pages 5 --dpi 300 [--handoff-only]
+"""
+import argparse
+import io
+import json
+import os
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pdfprocessor
+
+
+def prepare_png(pix):
+    """What the png path does before tesseract runs: PNG encode, decode, then pytesseract's PNG temp file"""
+    image = Image.open(io.BytesIO(pix.tobytes()))
+    temp_file = io.BytesIO()
+    image.save(temp_file, format=image.format)
+    return temp_file.getbuffer().nbytes
+
+
+def prepare_raw(pix):
+    return len(pdfprocessor.pixmap_to_pnm(pix))
+
+
+def run_path(pdf_path, path, page_count, dpi, handoff_only):
+    grayscale = path == "raw-gray"
+    doc = pdfprocessor.fitz.open(pdf_path)
+    page_times = []
+    for page_number in range(min(page_count, len(doc))):
+        started = time.perf_counter()
+        pix = pdfprocessor.render_page(doc.load_page(page_number), dpi, grayscale)
+        if handoff_only:
+            prepare_png(pix) if path == "png" else prepare_raw(pix)
+        elif path == "png":
+            pdfprocessor.ocr_pixmap(pix)
+        else:
+            pdfprocessor.ocr_pixmap_raw(pix, dpi)
+        page_times.append(time.perf_counter() - started)
+        pix = None
+    doc.close()
+
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / (1024 * 1024) if sys.platform == "darwin" else peak_rss / 1024
+    return {
+        "path": path,
+        "pages": len(page_times),
+        "mean_page_seconds": sum(page_times) / len(page_times) if page_times else 0.0,
+        "max_page_seconds": max(page_times, default=0.0),
+        "peak_rss_mb": round(peak_rss_mb, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the png and raw OCR handoff paths")
+    parser.add_argument("pdf_path")
+    parser.add_argument("--pages", type=int, default=5)
+    parser.add_argument("--dpi", type=int, default=300)
+    parser.add_argument("--handoff-only", action="store_true", help="Skip tesseract, time the image handoff only")
+    args = parser.parse_args()
+
+    results = []
+    for path in ("png", "raw", "raw-gray"):
+        # A fresh single-use process per path so peak RSS isn't shared between paths
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            results.append(executor.submit(run_path, args.pdf_path, path, args.pages, args.dpi, args.handoff_only).result())
+
+    print(json.dumps({"dpi": args.dpi, "handoff_only": args.handoff_only, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
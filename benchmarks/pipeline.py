@@ -0,0 +1,166 @@
+""" Benchmark of the ExtractPdf + SplitPdf pipeline.
+
+Runs the bundled Client1.pdf/Client2.pdf and synthetic K-3 style documents generated with fitz through the
+extract and split stages and prints per-stage timings, pages/sec and peak memory as JSON.
+
+Stages: render, ocr, assemble_save (building and saving the _EXTRACTED.pdf), text_index, range_finding,
+cropping and split_save. Every page is sent through OCR (pages with a text layer are not skipped) so render/OCR
+are measured on the bundled text PDFs too.
+
+--mock-ocr replaces tesseract with a copy of the source page, so the split stages can be benchmarked on a machine
+without tesseract. Stage timings come from the pipeline's own Metrics; each document runs in its own process so
+peak RSS is per document.
+
+Usage: python benchmarks/pipeline.py [--mock-ocr] [--synthetic-pages 50 200] [--dpi 300] [--output bench.json]
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+REPO_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_FOLDER)
+
+import pdfprocessor
+from pdfprocessor import ExtractPdf, SplitPdf, BoundaryMatcher, Metrics, fitz
+
+
+class MockOcrExtractPdf(ExtractPdf):
+    """ExtractPdf with tesseract replaced by a one page PDF carrying the source page's own text layer"""
+    def ocr_page(self, page):
+        with self.metrics.timer("render"):
+            pdfprocessor.render_page(page, self.dpi, self.grayscale)
+        with self.metrics.timer("ocr"):
+            ocr_page_doc = fitz.open()
+            ocr_page_doc.insert_pdf(page.parent, from_page=page.number, to_page=page.number)
+            ocr_result = ocr_page_doc.tobytes()
+            ocr_page_doc.close()
+        return ocr_result, False, self.dpi
+
+
+def make_synthetic_pdf(path, page_count):
+    """
+    Write a text PDF of page_count pages laid out like a K-1/K-3 package - every section's start text appears
+    in order across the document, each page padded with filler lines.
+    """
+    sections = list(pdfprocessor.SECTIONS.values())
+    doc = fitz.open()
+    for page_number in range(page_count):
+        page = doc.new_page(width=612, height=792)
+        start_texts, end_texts = sections[page_number * len(sections) // page_count][0]
+        page.insert_text((36, 50), start_texts[0], fontsize=9)
+        for line in range(40):
+            page.insert_text((36, 80 + line * 16), f"Line {line + 1} amount {page_number * 100 + line}.00", fontsize=8)
+        if page_number == page_count - 1:
+            page.insert_text((36, 760), "Reserved for Future Use", fontsize=9)
+        else:
+            page.insert_text((36, 760), end_texts[0], fontsize=9)
+    doc.save(path)
+    doc.close()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak_rss / (1024 * 1024) if sys.platform == "darwin" else peak_rss / 1024, 1)
+
+
+def benchmark_document(pdf_path, dpi, mock_ocr, crop_mode):
+    """Run one document through the whole pipeline in a scratch folder and return its stage timings"""
+    with tempfile.TemporaryDirectory() as work_folder:
+        output_folder = os.path.join(work_folder, "output")
+        os.makedirs(output_folder)
+        metrics = Metrics(quiet=True)
+
+        extractor_class = MockOcrExtractPdf if mock_ocr else ExtractPdf
+        extractor = extractor_class(pdf_path, output_folder, "BENCH_EXTRACTED", pdfprocessor.poppler_path,
+                                    dpi=dpi, skip_text_pages=False, metrics=metrics)
+        with metrics.timer("extract"):
+            extractor.convert_scanned_to_text_pdf()
+        extract_timings = dict(metrics.timings)
+
+        # SplitPdf names its output folder after the document path, so run it relative to the scratch folder
+        previous_folder = os.getcwd()
+        os.chdir(work_folder)
+        try:
+            splitter = SplitPdf(os.path.join("output", "BENCH_EXTRACTED.pdf"), "output", crop_mode=crop_mode,
+                                metrics=metrics)
+            sections = splitter.get_sections()
+            page_count = len(splitter.pdf_document)
+
+            with metrics.timer("text_index"):
+                splitter.build_page_index()
+            matcher = BoundaryMatcher(sections, metrics=metrics)
+            with metrics.timer("range_finding"):
+                section_ranges = splitter.find_all_section_ranges(sections, matcher)
+            split_timings = dict(metrics.timings)
+            with metrics.timer("split"):
+                splitter.split_all_sections(sections, matcher, section_ranges)
+            splitter.pdf_document.close()
+        finally:
+            os.chdir(previous_folder)
+
+    timings = metrics.timings
+    stages = {
+        "render": extract_timings.get("render", 0.0),
+        "ocr": extract_timings.get("ocr", 0.0),
+        "assemble_save": extract_timings["extract"] - extract_timings.get("render", 0.0) - extract_timings.get("ocr", 0.0),
+        "text_index": timings["text_index"],
+        "range_finding": timings["range_finding"],
+        # Crop rect matching and pixmap/show_pdf_page work done while splitting
+        "cropping": timings["crop"] + timings["matching"] - split_timings.get("matching", 0.0),
+    }
+    stages["split_save"] = timings["split"] - stages["cropping"]
+
+    total_seconds = sum(stages.values())
+    return {
+        "document": os.path.basename(pdf_path),
+        "pages": page_count,
+        "sections_found": sum(len(ranges) for ranges in section_ranges.values()),
+        "stages_seconds": {stage: round(seconds, 4) for stage, seconds in stages.items()},
+        "total_seconds": round(total_seconds, 4),
+        "pages_per_second": round(page_count / total_seconds, 2) if total_seconds else None,
+        "peak_rss_mb": peak_rss_mb(),
+        "counters": dict(metrics.counters),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the extract and split pipeline")
+    parser.add_argument("documents", nargs="*", help="PDFs to benchmark (default: the bundled Client1.pdf/Client2.pdf)")
+    parser.add_argument("--synthetic-pages", type=int, nargs="*", default=[50, 200],
+                        help="Page counts of the synthetic documents to generate (default: 50 200)")
+    parser.add_argument("--dpi", type=int, default=300)
+    parser.add_argument("--mock-ocr", action="store_true", help="Don't run tesseract, copy the source page instead")
+    parser.add_argument("--crop-mode", choices=SplitPdf.CROP_MODES, default="vector")
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    args = parser.parse_args()
+
+    documents = args.documents or [os.path.join(REPO_FOLDER, name) for name in ("Client1.pdf", "Client2.pdf")]
+
+    with tempfile.TemporaryDirectory() as synthetic_folder:
+        for page_count in args.synthetic_pages:
+            synthetic_path = os.path.join(synthetic_folder, f"synthetic_{page_count}.pdf")
+            make_synthetic_pdf(synthetic_path, page_count)
+            documents.append(synthetic_path)
+
+        results = []
+        for pdf_path in documents:
+            # A fresh process per document so peak RSS is per document
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                results.append(executor.submit(benchmark_document, pdf_path, args.dpi, args.mock_ocr,
+                                               args.crop_mode).result())
+
+    report = {"dpi": args.dpi, "mock_ocr": args.mock_ocr, "crop_mode": args.crop_mode, "results": results}
+    report_json = json.dumps(report, indent=2)
+    print(report_json)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            output_file.write(report_json)
+
+
+if __name__ == "__main__":
+    main()
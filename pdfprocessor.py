@@ -1,27 +1,415 @@
-#for extract pdf
-from PIL import Image
+#for extract pdf - PIL and pytesseract are imported where used, see load_pytesseract
 import io
 import os
-from difflib import SequenceMatcher
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-#for split pdf
-from fuzzywuzzy import fuzz
+#for split pdf - fuzzywuzzy and difflib are imported where used, see fuzz_ratio
 import sys
+import argparse
+import glob
+import time
+import hashlib
+import importlib.util
+import json
+import mmap
+import struct
+from array import array
+import shlex
+import subprocess
+import tempfile
+import threading
+from collections import namedtuple, deque, defaultdict
+from contextlib import contextmanager
+from functools import lru_cache
+from types import MappingProxyType
 
-#for both
-import fitz
-import pytesseract
-import os
 
-poppler_path = r"C:\Program Files\Release-24.07.0-0\poppler-24.07.0\Library\bin" 
-pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
+def lazy_import(name):
+    """
+    The module, executed on its first attribute access instead of now (importlib's LazyLoader).
+    Not thread safe before that first access - only for modules the main thread uses first.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+#for both - fitz loads when a PDF is first opened, so --help and argument errors don't pay for it
+fitz = lazy_import("fitz")
+
+# Tool locations - set PDFPROCESSOR_POPPLER_PATH / PDFPROCESSOR_TESSERACT_CMD to override,
+# otherwise the Windows install folders on Windows and the PATH elsewhere
+if os.name == 'nt':
+    poppler_path = os.environ.get("PDFPROCESSOR_POPPLER_PATH", r"C:\Program Files\Release-24.07.0-0\poppler-24.07.0\Library\bin")
+    tesseract_cmd = os.environ.get("PDFPROCESSOR_TESSERACT_CMD", r"C:\Program Files\Tesseract-OCR\tesseract.exe")
+else:
+    poppler_path = os.environ.get("PDFPROCESSOR_POPPLER_PATH")
+    tesseract_cmd = os.environ.get("PDFPROCESSOR_TESSERACT_CMD", "tesseract")
+
+
+def load_pytesseract():
+    """
+    Import pytesseract on first use and point it at tesseract_cmd.
+    Only the OCR paths pay for it (and PIL) - splitting an already extracted document never does.
+    """
+    import pytesseract
+    pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+    return pytesseract
+
+
+class Metrics:
+    """
+    Per-stage timings and counters for a run, shared by ExtractPdf and SplitPdf.
+
+    Time a stage with `with metrics.timer("ocr"):` and bump a counter with metrics.count("fuzzy_matches").
+    Diagnostics go through log(), which formats its arguments lazily - in quiet mode the hot matching loop
+    doesn't pay for building messages that are never shown.
+    Updates are locked so the streaming pipeline's OCR threads can share one Metrics.
+    """
+    def __init__(self, quiet=False):
+        self.quiet = quiet
+        self.timings = defaultdict(float)
+        self.timer_calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Locks can't be pickled - worker processes get a fresh one
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.timings[name] += elapsed
+                self.timer_calls[name] += 1
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def log(self, message, *args):
+        if not self.quiet:
+            print(message % args if args else message)
+
+    def merge(self, other):
+        """Add the timings and counters of another run (e.g. a worker process's as_dict()) to this one"""
+        with self.lock:
+            for name, seconds in other["timings_seconds"].items():
+                self.timings[name] += seconds
+            for name, calls in other["timer_calls"].items():
+                self.timer_calls[name] += calls
+            for name, amount in other["counters"].items():
+                self.counters[name] += amount
+
+    def as_dict(self):
+        return {
+            "timings_seconds": dict(self.timings),
+            "timer_calls": dict(self.timer_calls),
+            "counters": dict(self.counters),
+        }
+
+    def write_json(self, path):
+        with open(path, 'w', encoding='utf-8') as metrics_file:
+            json.dump(self.as_dict(), metrics_file, indent=2, sort_keys=True)
+
+
+def render_page(page, dpi=300, grayscale=False):
+    """Render a page to the pixmap that is OCR'd (grayscale is a third of the samples and enough for OCR)"""
+    colorspace = fitz.csGRAY if grayscale else fitz.csRGB
+    return page.get_pixmap(dpi=dpi, colorspace=colorspace, alpha=False)  # High DPI for better OCR results
+
+
+def ocr_pixmap(pix, lang=None, config=''):
+    """
+    OCR a rendered page into a one page text-based PDF through a PNG round trip and pytesseract.
+
+    :return: Bytes of the OCR'd PDF page.
+    """
+    return ocr_png(pix.tobytes(), lang, config)
+
+
+def ocr_png(png, lang=None, config=''):
+    """OCR a PNG encoded page with pytesseract (no fitz - safe to call from any thread)"""
+    from PIL import Image
+    pytesseract = load_pytesseract()
+    image = Image.open(io.BytesIO(png))
+
+    # Perform OCR to extract the text-based version of the page
+    return pytesseract.image_to_pdf_or_hocr(image, extension='pdf', lang=lang, config=config)
+
+
+def pixmap_to_pnm(pix):
+    """The pixmap as a binary PNM image - a short header in front of the raw samples, no encoding"""
+    pnm_type = {1: b"P5", 3: b"P6"}[pix.n]  # gray / rgb, pixmaps are rendered without alpha
+    return b"".join((b"%s\n%d %d\n255\n" % (pnm_type, pix.width, pix.height), pix.samples_mv))
+
+
+def ocr_pixmap_raw(pix, dpi, lang=None, config=''):
+    """
+    OCR a rendered page into a one page text-based PDF by streaming its raw samples to tesseract's stdin.
+    Unlike ocr_pixmap there is no PNG encode/decode, no PIL image and no temp files.
+
+    :return: Bytes of the OCR'd PDF page.
+    """
+    return ocr_pnm(pixmap_to_pnm(pix), dpi, lang, config)
+
+
+def ocr_pnm(pnm, dpi, lang=None, config=''):
+    """OCR a PNM page (see pixmap_to_pnm) with the tesseract command line (no fitz - safe to call from any thread)"""
+    return run_tesseract(pnm, dpi, lang, config)
+
+
+def run_tesseract(image_bytes, dpi, lang=None, config='', output_base="stdout", renderers=("pdf",)):
+    """
+    Run the tesseract command line on an image passed through stdin.
+
+    :param image_bytes: Any image tesseract reads (PNM, PNG).
+    :param output_base: "stdout" or the path tesseract adds each renderer's extension to.
+    :return: What tesseract wrote to stdout.
+    """
+    cmd_args = [tesseract_cmd, "stdin", output_base, "--dpi", str(dpi)]
+    if lang is not None:
+        cmd_args += ["-l", lang]
+    if config:
+        cmd_args += shlex.split(config, posix=os.name != 'nt')
+    cmd_args += renderers
+
+    try:
+        proc = subprocess.run(cmd_args, input=image_bytes, capture_output=True)
+    except FileNotFoundError:
+        raise load_pytesseract().TesseractNotFoundError()
+    if proc.returncode:
+        raise load_pytesseract().TesseractError(proc.returncode, proc.stderr.decode('utf-8', errors='replace'))
+    return proc.stdout
+
+
+def ocr_with_confidence(image_bytes, dpi, lang=None, config=''):
+    """
+    OCR a page into a one page text-based PDF and tesseract's word confidence for it, from one tesseract run.
+
+    :param image_bytes: Any image tesseract reads (PNM, PNG).
+    :return: (Bytes of the OCR'd PDF page, mean word confidence 0 - 100, see tsv_confidence)
+    """
+    with tempfile.TemporaryDirectory() as temp_folder:
+        output_base = os.path.join(temp_folder, "page")
+        run_tesseract(image_bytes, dpi, lang, config, output_base, ("pdf", "tsv"))
+        with open(f"{output_base}.pdf", 'rb') as pdf_file:
+            ocr_result = pdf_file.read()
+        with open(f"{output_base}.tsv", encoding='utf-8') as tsv_file:
+            confidence = tsv_confidence(tsv_file.read())
+    return ocr_result, confidence
+
+
+def pack_confidence(ocr_result, confidence):
+    """OCR'd page bytes and their confidence as one cache entry"""
+    return b"%.2f\n" % confidence + ocr_result
+
+
+def unpack_confidence(cached_result):
+    """:return: (OCR'd page bytes, confidence) of a pack_confidence entry"""
+    confidence, ocr_result = cached_result.split(b"\n", 1)
+    return ocr_result, float(confidence)
+
+
+def tsv_confidence(tsv):
+    """Mean confidence (0 - 100) of the words in tesseract's tsv output, 0 if no words were recognized"""
+    confidences = []
+    for line in tsv.splitlines()[1:]:
+        fields = line.split("\t")
+        # level 5 rows are words, conf is -1 for rows without text
+        if len(fields) == 12 and fields[0] == "5" and fields[11].strip() and float(fields[10]) >= 0:
+            confidences.append(float(fields[10]))
+    return sum(confidences) / len(confidences) if confidences else 0.0
+
+
+def ocr_page_batch(extractor, page_numbers):
+    """
+    Worker for parallel OCR - renders and OCRs its own run of pages from its own fitz handle.
+
+    :param extractor: The ExtractPdf whose settings (dpi, cache, tesseract options) are used.
+    :param page_numbers: Page numbers to OCR, in page order.
+    :return: (list of ExtractPdf.ocr_page results in page order, the worker's Metrics.as_dict())
+    """
+    extractor.metrics = Metrics(extractor.metrics.quiet)  # Only report this worker's own timings back
+    scanned_doc = fitz.open(extractor.scanned_pdf_path)
+    try:
+        results = [extractor.ocr_page(scanned_doc.load_page(page_number)) for page_number in page_numbers]
+        return results, extractor.metrics.as_dict()
+    finally:
+        scanned_doc.close()
+
+
+def save_section_worker(pdf_path, crop_mode, planned_pages, section_path):
+    """
+    Worker for parallel section writing - builds one part from its own fitz handle of the split PDF and saves it.
+
+    :param pdf_path: The PDF being split.
+    :param crop_mode: SplitPdf crop mode.
+    :param planned_pages: List of (page_number, crop rect as a tuple) in output order.
+    :param section_path: Path of the part PDF to write.
+    :return: The worker's Metrics.as_dict()
+    """
+    splitter = SplitPdf(pdf_path, os.path.dirname(section_path), crop_mode=crop_mode, metrics=Metrics(quiet=True))
+    output_pdf = fitz.open()
+    try:
+        for page_number, rect in planned_pages:
+            splitter.add_crop(output_pdf, splitter.pdf_document.load_page(page_number), fitz.Rect(rect))
+        with splitter.metrics.timer("save"):
+            output_pdf.save(section_path)
+        return splitter.metrics.as_dict()
+    finally:
+        output_pdf.close()
+        splitter.pdf_document.close()
+
+
+def image_coverage(page):
+    """Fraction (0 - 1) of the page area covered by images"""
+    page_area = abs(page.rect)
+    if not page_area:
+        return 0.0
+    covered = sum(abs(fitz.Rect(image["bbox"]) & page.rect) for image in page.get_image_info())
+    return min(covered / page_area, 1.0)
+
+
+def has_text_layer(page, min_text_chars=50, max_image_coverage=0.5):
+    """
+    True if the page is native text - it has a real text layer and is not mostly a scanned image - so it doesn't need OCR.
+    """
+    if len(page.get_text("text").strip()) < min_text_chars:
+        return False
+    return image_coverage(page) <= max_image_coverage
+
+
+def file_sha256(path):
+    """Hex sha256 of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class OcrCache:
+    """
+    On-disk, content-addressed cache of per-page OCR results.
+
+    Entries are keyed by the hash of the rendered page plus the OCR settings (dpi, tesseract version, lang, config),
+    so a changed page misses and an unchanged page hits whatever the file is called. Once the cache grows past
+    max_bytes the least recently used entries are removed (a hit refreshes the entry's mtime).
+
+    The cache size is scanned from disk once and then kept as a running total of this process's writes; only when
+    that estimate passes max_bytes is the folder scanned again and trimmed, down to EVICT_TO of max_bytes so the
+    next scan is many writes away. Other processes writing the same cache are picked up by those scans.
+    """
+    EVICT_TO = 0.9
+
+    def __init__(self, cache_folder, max_bytes=1024 * 1024 * 1024):
+        self.cache_folder = cache_folder
+        self.max_bytes = max_bytes
+        self.total_bytes = None  # Estimated size of the cache, scanned on the first put
+
+    def key(self, pix, settings):
+        digest = hashlib.sha256(settings.encode('utf-8'))
+        digest.update(f"{pix.width}x{pix.height}x{pix.n}".encode('utf-8'))
+        digest.update(pix.samples_mv)
+        return digest.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_folder, key[:2], f"{key}.pdf")
+
+    def get(self, key):
+        path = self.entry_path(key)
+        try:
+            with open(path, 'rb') as entry:
+                data = entry.read()
+            os.utime(path)  # Mark as recently used
+            return data
+        except OSError:
+            return None
+
+    def put(self, key, data):
+        path = self.entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so parallel workers never see a partial entry
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as entry:
+            entry.write(data)
+        if self.total_bytes is None:
+            self.total_bytes = self.scan()[1]
+        try:
+            self.total_bytes -= os.path.getsize(path)  # Replacing an existing entry
+        except OSError:
+            pass
+        os.replace(temp_path, path)
+        self.total_bytes += len(data)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def scan(self):
+        """(entries as (mtime, size, path), total bytes) of the cache on disk"""
+        entries = []
+        total_bytes = 0
+        for path in glob.glob(os.path.join(self.cache_folder, "*", "*.pdf")):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # Removed by another worker
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total_bytes += stat.st_size
+        return entries, total_bytes
+
+    def evict(self):
+        """Remove least recently used entries until the cache is within EVICT_TO of max_bytes"""
+        entries, total_bytes = self.scan()
+        if total_bytes > self.max_bytes:
+            for _, size, path in sorted(entries):
+                if total_bytes <= self.max_bytes * self.EVICT_TO:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total_bytes -= size
+        self.total_bytes = total_bytes
+
+
+def split_page_ranges(total_pages, parts):
+    """Split total_pages into at most `parts` contiguous (start, end) ranges"""
+    size = -(-total_pages // max(parts, 1))  # ceiling division
+    return [(start, min(start + size, total_pages)) for start in range(0, total_pages, size)] if size else []
+
 
 """ Class for extracting SCANNED IMAGE PDFs to text based PDFs (of the same table format) so we can then split it using SplitPdf
-*** IF ALREADY TEXT BASED THE PDF WILL BE SKIPPED FROM THIS CLASS. ***
+*** PAGES THAT ARE ALREADY TEXT BASED ARE COPIED AS IS INSTEAD OF BEING OCR'd. ***
 """
 
 class ExtractPdf:
-    def __init__(self, scanned_pdf_path, output_folder, output_name, poppler_path):
+    OCR_HANDOFFS = ("raw", "png")
+    # (top, bottom) page height fractions scan_headers OCRs - the top two thirds reach the lowest section title or end
+    # text of the bundled package (64% of the page, K-1's end text on the K-3 title page) and the bottom band has the
+    # K-1 end text of the form pages. Measured on that one document (Client1.pdf and Client2.pdf are the same file).
+    HEADER_BANDS = ((0.0, 0.66), (0.94, 1.0))
+
+    def __init__(self, scanned_pdf_path, output_folder, output_name, poppler_path, workers=1, dpi=300,
+                 cache_folder=None, cache_max_bytes=1024 * 1024 * 1024, lang=None, config='', skip_text_pages=True,
+                 ocr_handoff="raw", grayscale=False, chunk_size=None, metrics=None, adaptive_dpi=None,
+                 min_confidence=80, ocr_only_pages=None, header_bands=None):
         """
         Initialize the ExtractPdf class with necessary parameters.
         
@@ -29,193 +417,1024 @@ class ExtractPdf:
         :param output_folder: Directory where output files will be saved.
         :param output_name: Base name for output files (without extension).
         :param poppler_path: Path to Poppler (if needed).
+        :param workers: Number of OCR processes (1 = OCR pages serially in this process).
+        :param dpi: Render resolution used for OCR.
+        :param cache_folder: Directory of the per-page OCR cache (None disables the cache).
+        :param cache_max_bytes: Size cap of the OCR cache, least recently used pages are evicted past it.
+        :param lang: Tesseract language(s), None for tesseract's default.
+        :param config: Extra tesseract command line options.
+        :param skip_text_pages: Copy pages that already have a text layer instead of OCRing them.
+        :param ocr_handoff: "raw" streams the pixmap samples to tesseract, "png" goes through PNG and pytesseract.
+        :param grayscale: Render pages in grayscale for OCR (the OCR'd pages are grayscale too).
+        :param chunk_size: Stream the output to disk every chunk_size pages so memory stays flat and an interrupted
+                           run resumes from the last completed chunk (None = build the whole document in memory).
+        :param metrics: Metrics to record timings and counters in (a new one if None).
+        :param adaptive_dpi: Adaptive mode - OCR every page at this lower dpi first and re-render only the pages whose
+                             tesseract word confidence is below min_confidence at dpi (None = every page at dpi).
+        :param min_confidence: Mean word confidence (0 - 100) a first pass page needs to be kept.
+        :param ocr_only_pages: Page numbers to OCR, the other pages are copied as they are (None = every page).
+        :param header_bands: (top, bottom) page height fractions scan_headers OCRs (None = HEADER_BANDS).
         """
+        if ocr_handoff not in self.OCR_HANDOFFS:
+            raise ValueError(f"ocr_handoff must be one of {self.OCR_HANDOFFS}, got '{ocr_handoff}'")
+        header_bands = self.HEADER_BANDS if header_bands is None else tuple(tuple(band) for band in header_bands)
+        if not header_bands or not all(len(band) == 2 and 0 <= band[0] < band[1] <= 1 for band in header_bands):
+            raise ValueError(f"header_bands must be (top, bottom) fractions with 0 <= top < bottom <= 1, "
+                             f"got {header_bands}")
         self.scanned_pdf_path = scanned_pdf_path
         self.output_folder = output_folder
         self.output_name = output_name
         self.poppler_path = poppler_path
+        self.workers = max(1, workers)
+        self.dpi = dpi
+        self.cache = OcrCache(cache_folder, cache_max_bytes) if cache_folder else None
+        self.lang = lang
+        self.config = config
+        self.skip_text_pages = skip_text_pages
+        self.ocr_handoff = ocr_handoff
+        self.grayscale = grayscale
+        self.chunk_size = chunk_size
+        self.adaptive_dpi = adaptive_dpi
+        self.min_confidence = min_confidence
+        self.page_dpis = {}  # page number -> dpi the page was OCR'd at
+        self.ocr_only_pages = None if ocr_only_pages is None else set(ocr_only_pages)
+        self.header_bands = header_bands
+        self.tesseract_version = None  # Looked up on first cached OCR
+        self.metrics = metrics if metrics is not None else Metrics()
         
         self.ocr_pdf_path = os.path.join(self.output_folder, f"{self.output_name}.pdf")
         self.output_text_path = os.path.join(self.output_folder, f"{self.output_name}.txt")
+        # Fingerprints of the inputs each output was built from, used to decide if the output is stale
+        self.ocr_fingerprint_path = f"{self.ocr_pdf_path}.sha256"
+        self.text_fingerprint_path = f"{self.output_text_path}.sha256"
+        # Streaming mode: the output being appended to and how far it got
+        self.partial_pdf_path = f"{self.ocr_pdf_path}.partial"
+        self.progress_path = f"{self.ocr_pdf_path}.progress"
+        # Adaptive mode: the dpi each page was OCR'd at
+        self.dpi_report_path = f"{self.ocr_pdf_path}.dpi.json"
+        # Text blocks with their page numbers and rects, loaded by SplitPdf instead of parsing the OCR PDF again
+        self.layout_index_path = f"{self.ocr_pdf_path}.layout"
+        self.layout_fingerprint_path = f"{self.layout_index_path}.sha256"
+
+    def ocr_settings(self, dpi=None):
+        """Everything besides the page image that changes the OCR result"""
+        if self.tesseract_version is None:
+            self.tesseract_version = str(load_pytesseract().get_tesseract_version())
+        return (f"dpi={dpi or self.dpi};tesseract={self.tesseract_version};lang={self.lang};config={self.config}"
+                f";handoff={self.ocr_handoff};grayscale={self.grayscale}")
+
+    def source_fingerprint(self):
+        fingerprint = (f"{file_sha256(self.scanned_pdf_path)};dpi={self.dpi};lang={self.lang};config={self.config}"
+                       f";skip_text_pages={self.skip_text_pages};handoff={self.ocr_handoff};grayscale={self.grayscale}")
+        if self.adaptive_dpi is not None:
+            fingerprint += f";adaptive_dpi={self.adaptive_dpi};min_confidence={self.min_confidence}"
+        if self.ocr_only_pages is not None:
+            fingerprint += f";ocr_only_pages={','.join(str(page_number) for page_number in sorted(self.ocr_only_pages))}"
+        return fingerprint
+
+    def is_selected(self, page_number):
+        """False for pages left out by ocr_only_pages, which are copied without OCR"""
+        return self.ocr_only_pages is None or page_number in self.ocr_only_pages
+
+    def is_up_to_date(self, output_path, fingerprint_path, fingerprint):
+        """True if output_path exists and was built from inputs with the given fingerprint"""
+        if not os.path.exists(output_path) or not os.path.exists(fingerprint_path):
+            return False
+        with open(fingerprint_path, encoding='utf-8') as fingerprint_file:
+            return fingerprint_file.read() == fingerprint
+
+    def write_fingerprint(self, fingerprint_path, fingerprint):
+        with open(fingerprint_path, 'w', encoding='utf-8') as fingerprint_file:
+            fingerprint_file.write(fingerprint)
+
+    def invalidate_ocr_pdf(self):
+        """
+        Remove the OCR PDF of a previous run and its fingerprint before rebuilding it, so a failed rebuild
+        can't leave stale output that a later stage or run takes for current.
+        """
+        for path in (self.ocr_fingerprint_path, self.ocr_pdf_path):
+            if os.path.exists(path):
+                os.remove(path)
 
     def convert_scanned_to_text_pdf(self):
         """
         Convert a scanned PDF to a text-based PDF using OCR or skip if already text-based.
+        Errors are raised - the OCR PDF is only written (and fingerprinted) once every page converted.
         """
-        # Check if OCR PDF already exists
-        if os.path.exists(self.ocr_pdf_path):
-            print(f"Skipping OCR conversion. The file {self.ocr_pdf_path} already exists.")
-            return  # Skip the conversion if the file exists
+        # Skip if the OCR PDF was already built from this exact file with the same settings
+        fingerprint = self.source_fingerprint()
+        if self.is_up_to_date(self.ocr_pdf_path, self.ocr_fingerprint_path, fingerprint):
+            self.metrics.log(f"Skipping OCR conversion. The file {self.ocr_pdf_path} is up to date.")
+            return  # Skip the conversion if the file is up to date
         
-        print("Extracting PDF using OCR...")
+        self.metrics.log("Extracting PDF using OCR...")
+        counters_before = dict(self.metrics.counters)
+        self.invalidate_ocr_pdf()
 
+        scanned_doc = ocr_doc = None
         try:
             scanned_doc = fitz.open(self.scanned_pdf_path)
-            ocr_doc = fitz.open()  # Create a new blank PDF
-
-            for page_number in range(len(scanned_doc)):
-                page = scanned_doc.load_page(page_number)
-                pix = page.get_pixmap(dpi=300)  # High DPI for better OCR results
-                image = Image.open(io.BytesIO(pix.tobytes()))
-
-                # Perform OCR to extract the text-based version of the page
-                ocr_result = pytesseract.image_to_pdf_or_hocr(image, extension='pdf')
-                # Create a new PDF page from OCR result
-                ocr_page = fitz.open("pdf", ocr_result)
-                ocr_doc.insert_pdf(ocr_page)  # Insert OCR page into the new PDF
-
-            ocr_doc.save(self.ocr_pdf_path)
-            print(f"OCR PDF saved as: {self.ocr_pdf_path}")
-        except Exception as e:
-            print(f"Error during PDF conversion: {e}")
+
+            if self.chunk_size:
+                self.convert_in_chunks(scanned_doc, fingerprint)
+            else:
+                ocr_doc = fitz.open()  # Create a new blank PDF
+                for page_number, ocr_result in self.ocr_pages(scanned_doc):
+                    self.add_page(ocr_doc, scanned_doc, page_number, ocr_result)
+                # Save then rename so the OCR PDF only ever exists complete
+                temp_path = f"{self.ocr_pdf_path}.tmp"
+                with self.metrics.timer("save"):
+                    ocr_doc.save(temp_path)
+                os.replace(temp_path, self.ocr_pdf_path)
+
+            self.write_fingerprint(self.ocr_fingerprint_path, fingerprint)
+            self.metrics.log(f"OCR PDF saved as: {self.ocr_pdf_path}")
+            self.log_page_counts(counters_before)
+            if self.adaptive_dpi is not None:
+                self.write_dpi_report()
+        finally:
+            if scanned_doc is not None:
+                scanned_doc.close()
+            if ocr_doc is not None:
+                ocr_doc.close()
+
+    def log_page_counts(self, counters_before):
+        """Log how the pages of this conversion were handled - counters_before is a copy of the counters at its start"""
+        run_counts = {name: self.metrics.counters[name] - counters_before.get(name, 0)
+                      for name in ("pages_ocr", "pages_text_layer", "ocr_cache_hits")}
+        self.metrics.log(f"Pages: {run_counts['pages_ocr']} OCR'd, "
+                         f"{run_counts['pages_text_layer']} copied with their existing text layer")
+        if self.cache is not None:
+            self.metrics.log(f"OCR cache: {run_counts['ocr_cache_hits']} of {run_counts['pages_ocr']} OCR'd pages reused")
+
+    def write_dpi_report(self):
+        """Log how many pages were OCR'd at each dpi and save the dpi of every page (1-based) next to the OCR PDF"""
+        pages_at_dpi = defaultdict(int)
+        for dpi in self.page_dpis.values():
+            pages_at_dpi[dpi] += 1
+        self.metrics.log("Pages OCR'd at each dpi: " + ", ".join(f"{dpi} dpi: {pages}"
+                                                                  for dpi, pages in sorted(pages_at_dpi.items())))
+        with open(self.dpi_report_path, 'w', encoding='utf-8') as report_file:
+            json.dump({"page_dpi": {str(page_number + 1): dpi for page_number, dpi in sorted(self.page_dpis.items())}},
+                      report_file, indent=2)
+
+    def add_page(self, ocr_doc, scanned_doc, page_number, ocr_result):
+        """Append one page from ocr_pages to ocr_doc"""
+        if ocr_result is None:
+            # Page already has a text layer - copy it as is
+            ocr_doc.insert_pdf(scanned_doc, from_page=page_number, to_page=page_number)
+            return
+        # Create a new PDF page from OCR result
+        ocr_page_doc = fitz.open("pdf", ocr_result)
+        ocr_doc.insert_pdf(ocr_page_doc)  # Insert OCR page into the new PDF
+        ocr_page_doc.close()
+
+    def read_progress(self, fingerprint):
+        """Number of pages already in the partial output of an interrupted run of the same input (0 to start over)"""
+        try:
+            with open(self.progress_path, encoding='utf-8') as progress_file:
+                progress = json.load(progress_file)
+            if progress["fingerprint"] != fingerprint:
+                return 0
+            page_dpis = {int(page_number): dpi for page_number, dpi in progress.get("page_dpi", {}).items()}
+            partial_doc = fitz.open(self.partial_pdf_path)
+            partial_pages = len(partial_doc)
+            partial_doc.close()
+        except (OSError, ValueError, KeyError, RuntimeError):
+            return 0  # No usable progress or a damaged partial file
+        if partial_pages != progress["pages_done"]:
+            return 0
+        self.page_dpis.update(page_dpis)
+        return progress["pages_done"]
+
+    def write_progress(self, fingerprint, pages_done):
+        temp_path = f"{self.progress_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as progress_file:
+            json.dump({"fingerprint": fingerprint, "pages_done": pages_done, "page_dpi": self.page_dpis}, progress_file)
+        os.replace(temp_path, self.progress_path)
+
+    def convert_in_chunks(self, scanned_doc, fingerprint):
+        """
+        Streaming conversion - OCR chunk_size pages at a time, append each chunk to the partial output on disk
+        with an incremental save and record the progress, so only one chunk is ever held in memory.
+        A rerun after an interruption resumes after the last completed chunk.
+        """
+        total_pages = len(scanned_doc)
+        pages_done = self.read_progress(fingerprint)
+        if pages_done:
+            self.metrics.log(f"Resuming OCR from page {pages_done + 1} of {total_pages}")
+        elif os.path.exists(self.partial_pdf_path):
+            os.remove(self.partial_pdf_path)
+
+        while pages_done < total_pages:
+            chunk_end = min(pages_done + self.chunk_size, total_pages)
+            chunk_doc = fitz.open()
+            for page_number, ocr_result in self.ocr_pages(scanned_doc, range(pages_done, chunk_end)):
+                self.add_page(chunk_doc, scanned_doc, page_number, ocr_result)
+
+            with self.metrics.timer("save"):
+                if pages_done == 0:
+                    chunk_doc.save(self.partial_pdf_path)
+                else:
+                    partial_doc = fitz.open(self.partial_pdf_path)
+                    partial_doc.insert_pdf(chunk_doc)
+                    partial_doc.saveIncr()  # Appends only the new objects to the file
+                    partial_doc.close()
+            chunk_doc.close()
+
+            pages_done = chunk_end
+            self.write_progress(fingerprint, pages_done)
+            fitz.TOOLS.store_shrink(100)  # Release MuPDF's cached page resources
+            self.metrics.log(f"OCR progress: {pages_done} of {total_pages} pages")
+
+        os.replace(self.partial_pdf_path, self.ocr_pdf_path)
+        os.remove(self.progress_path)
+
+    def ocr_page(self, page):
+        """
+        Render and OCR one page, reusing the cached result if this exact page image was OCR'd before.
+        In adaptive mode the page is OCR'd at adaptive_dpi and only re-rendered at dpi if its confidence is too low.
+
+        :return: (OCR'd PDF page bytes, came from cache, dpi the page was OCR'd at)
+        """
+        if self.adaptive_dpi is not None:
+            ocr_result, confidence, cached = self.ocr_page_with_confidence(page, self.adaptive_dpi)
+            if not self.needs_reocr(page.number, confidence):
+                return ocr_result, cached, self.adaptive_dpi
+
+        ocr_result, cached = self.ocr_page_at(page, self.dpi)
+        return ocr_result, cached, self.dpi
+
+    def needs_reocr(self, page_number, confidence):
+        """True if an adaptive first pass page is below min_confidence and has to be OCR'd again at dpi"""
+        if confidence >= self.min_confidence:
+            return False
+        self.metrics.log("Page %s: confidence %.0f at %s dpi, OCRing again at %s dpi",
+                         page_number + 1, confidence, self.adaptive_dpi, self.dpi)
+        self.metrics.count("pages_reocr")
+        return True
+
+    def ocr_page_at(self, page, dpi):
+        """:return: (OCR'd PDF page bytes of page rendered at dpi, came from cache)"""
+        with self.metrics.timer("render"):
+            pix = render_page(page, dpi, self.grayscale)
+        if self.cache is None:
+            return self.ocr_pixmap(pix, dpi), False
+
+        key = self.cache.key(pix, self.ocr_settings(dpi))
+        ocr_result = self.cache.get(key)
+        if ocr_result is not None:
+            return ocr_result, True
+
+        ocr_result = self.ocr_pixmap(pix, dpi)
+        self.cache.put(key, ocr_result)
+        return ocr_result, False
+
+    def ocr_page_with_confidence(self, page, dpi):
+        """
+        Adaptive first pass - the page rendered at dpi and OCR'd along with tesseract's confidence.
+        The cache keeps the confidence in front of the PDF bytes, under its own settings key.
+
+        :return: (OCR'd PDF page bytes, mean word confidence, came from cache)
+        """
+        with self.metrics.timer("render"):
+            pix = render_page(page, dpi, self.grayscale)
+            image_bytes = self.encode_for_ocr(pix)
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(pix, self.ocr_settings(dpi) + ";confidence")
+            cached_result = self.cache.get(key)
+            if cached_result is not None:
+                return unpack_confidence(cached_result) + (True,)
+
+        ocr_result, confidence = self.ocr_image_with_confidence(image_bytes, dpi)
+        if key is not None:
+            self.cache.put(key, pack_confidence(ocr_result, confidence))
+        return ocr_result, confidence, False
+
+    def ocr_image_with_confidence(self, image_bytes, dpi):
+        """ocr_with_confidence of an encode_for_ocr image - doesn't use fitz, so it can run on any thread"""
+        with self.metrics.timer("ocr"):
+            return ocr_with_confidence(image_bytes, dpi, self.lang, self.config)
+
+    def ocr_pixmap(self, pix, dpi=None):
+        with self.metrics.timer("ocr"):
+            return self.ocr_encoded(self.encode_for_ocr(pix), dpi)
+
+    def encode_for_ocr(self, pix):
+        """The rendered page as handed to tesseract - PNM for the raw handoff, PNG for pytesseract"""
+        if self.ocr_handoff == "raw":
+            return pixmap_to_pnm(pix)
+        return pix.tobytes()
+
+    def ocr_encoded(self, image_bytes, dpi=None):
+        """OCR an encode_for_ocr image into PDF page bytes - doesn't use fitz, so it can run on any thread"""
+        if self.ocr_handoff == "raw":
+            return ocr_pnm(image_bytes, dpi or self.dpi, self.lang, self.config)
+        return ocr_png(image_bytes, self.lang, self.config)
+
+    def ocr_pages(self, scanned_doc, page_numbers=None):
+        """
+        Yield (page_number, OCR'd PDF bytes) for every page (or the given page_numbers) of scanned_doc in page order.
+        Pages that already have a text layer are yielded with None instead of being OCR'd.
+        With workers > 1 each worker process renders and OCRs its own run of pages.
+        """
+        if page_numbers is None:
+            page_numbers = range(len(scanned_doc))
+        # Pages left out by ocr_only_pages are copied the same way as pages with a text layer
+        unselected_pages = {page_number for page_number in page_numbers if not self.is_selected(page_number)}
+        text_pages = set()
+        if self.skip_text_pages:
+            text_pages = {page_number for page_number in page_numbers
+                          if page_number not in unselected_pages and has_text_layer(scanned_doc.load_page(page_number))}
+        self.metrics.count("pages_not_selected", len(unselected_pages))
+        text_pages |= unselected_pages
+        ocr_page_numbers = [page_number for page_number in page_numbers if page_number not in text_pages]
+        self.metrics.count("pages_text_layer", len(text_pages) - len(unselected_pages))
+        self.metrics.count("pages_ocr", len(ocr_page_numbers))
+
+        if self.workers == 1 or len(ocr_page_numbers) < 2:
+            page_results = (self.ocr_page(scanned_doc.load_page(page_number)) for page_number in ocr_page_numbers)
+        else:
+            page_results = self.ocr_pages_parallel(ocr_page_numbers)
+
+        for page_number in page_numbers:
+            if page_number in text_pages:
+                yield page_number, None
+                continue
+            ocr_result, cached, dpi = next(page_results)
+            self.metrics.count("ocr_cache_hits", cached)
+            self.page_dpis[page_number] = dpi
+            yield page_number, ocr_result
+
+    def ocr_pages_parallel(self, page_numbers):
+        page_ranges = split_page_ranges(len(page_numbers), self.workers)
+        self.metrics.log(f"OCR using {len(page_ranges)} worker processes...")
+        with ProcessPoolExecutor(max_workers=len(page_ranges)) as executor:
+            futures = [executor.submit(ocr_page_batch, self, page_numbers[start:end]) for start, end in page_ranges]
+            # Futures are consumed in submission order so pages are reassembled in page order
+            for future in futures:
+                results, worker_metrics = future.result()
+                self.metrics.merge(worker_metrics)
+                yield from results
+
+    def scan_headers(self, dpi=150, bands=None):
+        """
+        Boundary detection pass - a page index (see SplitPdf.build_page_index) of the text in horizontal bands of
+        every page. Pages with a text layer use their own text (unless skip_text_pages is off); for scanned pages the
+        bands are rendered at a low dpi and OCR'd, with up to `workers` tesseract processes at once like the full OCR
+        pass. The default bands cover 72% of every page, so this is a low dpi OCR of most of the document rather
+        than of a header line. A start or end text outside the bands is not in the index - it is only seen on the
+        pages that are fully OCR'd afterwards.
+
+        :param dpi: Render resolution of the bands.
+        :param bands: (top, bottom) fractions of the page height to OCR (default: the extractor's header_bands).
+        :return: List (indexed by page number) of TextBlock lists in page coordinates.
+        """
+        if bands is None:
+            bands = self.header_bands
+        self.metrics.log("Scanning page bands for section boundaries...")
+        scanned_doc = fitz.open(self.scanned_pdf_path)
+        try:
+            page_index = [[] for _ in range(len(scanned_doc))]
+            band_results = []  # (page_number, band rect, OCR'd band or its future, cache key) in page order
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for page_number in range(len(scanned_doc)):
+                    page = scanned_doc.load_page(page_number)
+                    if self.skip_text_pages and has_text_layer(page):
+                        page_index[page_number] = to_text_blocks(page_number, page.get_text("blocks"))
+                        continue
+
+                    for top, bottom in bands:
+                        band_rect = fitz.Rect(page.rect.x0, page.rect.y0 + page.rect.height * top,
+                                              page.rect.x1, page.rect.y0 + page.rect.height * bottom)
+                        with self.metrics.timer("render"):
+                            pix = page.get_pixmap(dpi=dpi, clip=band_rect, colorspace=fitz.csGRAY, alpha=False)
+                        self.metrics.count("header_bands_ocr")
+                        cache_key = None
+                        if self.cache is not None:
+                            cache_key = self.cache.key(pix, self.ocr_settings(dpi) + ";header")
+                            ocr_result = self.cache.get(cache_key)
+                            if ocr_result is not None:
+                                band_results.append((page_number, band_rect, ocr_result, None))
+                                continue
+                        future = executor.submit(self.ocr_header, self.encode_for_ocr(pix), dpi)
+                        band_results.append((page_number, band_rect, future, cache_key))
+
+                for page_number, band_rect, ocr_result, cache_key in band_results:
+                    if not isinstance(ocr_result, bytes):
+                        ocr_result = ocr_result.result()
+                        if cache_key is not None:
+                            self.cache.put(cache_key, ocr_result)
+                    page_index[page_number] += self.header_blocks(page_number, ocr_result, band_rect)
+            return page_index
         finally:
             scanned_doc.close()
-            ocr_doc.close()
+
+    def ocr_header(self, image_bytes, dpi):
+        with self.metrics.timer("ocr"):
+            return self.ocr_encoded(image_bytes, dpi)
+
+    def header_blocks(self, page_number, ocr_result, band_rect):
+        """TextBlocks of an OCR'd band, moved from band to page coordinates"""
+        band_doc = fitz.open("pdf", ocr_result)
+        blocks = band_doc.load_page(0).get_text("blocks")
+        band_doc.close()
+        x0, y0 = band_rect.x0, band_rect.y0
+        return to_text_blocks(page_number, [(block[0] + x0, block[1] + y0, block[2] + x0, block[3] + y0) + tuple(block[4:])
+                                            for block in blocks])
 
     def extract_text_blocks(self):
         """
-        Extract all text blocks from the OCR PDF and save them to a text file for inspection.
+        Extract all text blocks from the OCR PDF and save them to a text file for inspection,
+        and with their page numbers and rects to the layout index (see LayoutIndex).
         """
-        # Check if output text file already exists
-        if os.path.exists(self.output_text_path):
-            print(f"Skipping text extraction. The file {self.output_text_path} already exists.")
-            return  # Skip extraction if the file exists
+        # Skip if the text file and layout index were already extracted from this exact OCR PDF
+        fingerprint = file_sha256(self.ocr_pdf_path)
+        if (self.is_up_to_date(self.output_text_path, self.text_fingerprint_path, fingerprint)
+                and self.is_up_to_date(self.layout_index_path, self.layout_fingerprint_path, fingerprint)):
+            self.metrics.log(f"Skipping text extraction. The file {self.output_text_path} is up to date.")
+            return  # Skip extraction if the file is up to date
         
-        print("\nExtracting text blocks from the OCR PDF...")
+        self.metrics.log("\nExtracting text blocks from the OCR PDF...")
         
         doc = fitz.open(self.ocr_pdf_path)
         
         try:
+            page_index = []
             with open(self.output_text_path, 'w', encoding='utf-8') as text_file:
                 for page_number in range(len(doc)):
                     page = doc.load_page(page_number)
-                    blocks = page.get_text("blocks")  # Extract text blocks
+                    with self.metrics.timer("get_text"):
+                        blocks = page.get_text("blocks")  # Extract text blocks
                     
                     text_file.write(f"\n--- Page {page_number + 1} ---\n")
                     for block in blocks:
                         text = block[4]  # The text content of the block
                         text_file.write(text.strip() + "\n")  # Write the text block content to file
+                    page_index.append(to_text_blocks(page_number, blocks))
 
-            print(f"Extracted text saved to: {self.output_text_path}")
-
-        except Exception as e:
-            print(f"Error during text extraction: {e}")
+            self.write_fingerprint(self.text_fingerprint_path, fingerprint)
+            self.metrics.log(f"Extracted text saved to: {self.output_text_path}")
+            self.write_layout_index(page_index, fingerprint)
 
         finally:
             doc.close()
 
+    def write_layout_index(self, page_index, fingerprint):
+        """Save page_index as the layout index of the OCR PDF with the given fingerprint"""
+        LayoutIndex.write(self.layout_index_path, page_index)
+        self.write_fingerprint(self.layout_fingerprint_path, fingerprint)
+        self.metrics.log(f"Layout index saved to: {self.layout_index_path}")
 
+    def fresh_layout_index_path(self):
+        """The layout index path if it matches the current OCR PDF, else None"""
+        if not os.path.exists(self.ocr_pdf_path):
+            return None
+        if self.is_up_to_date(self.layout_index_path, self.layout_fingerprint_path, file_sha256(self.ocr_pdf_path)):
+            return self.layout_index_path
+        return None
 
-""" Class for splitting the output selectable ocr pdf into sections for the K3 Tax Document"""
-class SplitPdf:
-    def __init__(self, pdf_document, output_folder):
-        self.pdf_document = fitz.open(pdf_document)
-        self.output_folder = output_folder
- 
-        """ Start and end texts to split by section - if start has more than one value it will iterate until value found"""
-        self.K1_form = [
-            (["Schedule K-1 "],
-            ["For Paperwork Reduction Act Notice, see the Instructions for Form 1065."])
-        ]
- 
-        self.K3_title_page =  [
-                (["Credits, etc.—International", "Credits, etc.-International ", "Credits, etc. - International"],
-                ["For Paperwork Reduction Act Notice, see the Instructions for Form 1065."])
-            ]
-           
- 
-        self._1 = [
-                (["Check box(es) for additional specified attachments. See instructions."],
-                ["13. Other international items"])
-            ]
- 
-        self._2 = [
-                (["Foreign Tax Credit Limitation","Foreign Tax Credit Limitation (continued)"],
-                [
-                    "Other Information for Preparation of Form 1116 or 1118",
-                    "Information on Partner’s Section 250 Deduction With Respect to Foreign-Derived Intangible Income (FDI)",
-                    "Information on Partner’s Section 951(a)(1) and Section 951A Inclusions",
-                    "Distributions From Foreign Corporations to Partnership",
-                    "Information Regarding Passive Foreign Investment Companies (PFICs)",
-                    "Partner’s Interest in Foreign Corporation Income (Section 960)",
-                    "Partner’s Information for Base Erosion and Anti-Abuse Tax (Section 59A)",
-                    "Foreign Partner’s Character and Source of Income and Deductions",
-                    "Section 871(m) Covered Partnerships",
-                    "Reserved for Future Use",
-                    "Gain that would be recognized under section 897(g) on the deemed sale of section 1(h)(6) unrecaptured section 1250 gain assets."
-                ])
-            ]
- 
-        self._3 = [
-            (["Other Information for Preparation of Form 1116 or 1118", "Other Information for Preparation of Form 1116 or 1118 (continued)"],
-            [
+
+
+""" A non-empty text block of a page: original text, (x0, y0, x1, y1) rect and lowercased text for fuzzy matching"""
+TextBlock = namedtuple("TextBlock", ["page_number", "text", "rect", "normalized_text"])
+
+
+def to_text_blocks(page_number, blocks):
+    """TextBlocks of the non-empty blocks of a page's get_text("blocks")"""
+    text_blocks = []
+    for block in blocks:
+        block_text, block_rect = block[4], block[:4]
+        if block_text.strip():
+            text_blocks.append(TextBlock(page_number, block_text, block_rect, block_text.lower()))
+    return text_blocks
+
+
+class LayoutIndex:
+    """
+    Compact, memory mapped page index (the TextBlocks of every page) saved next to the _EXTRACTED outputs,
+    so a document can be split again without fitz parsing its text.
+
+    File layout - a header (MAGIC, page count, block count, text blob size as uint32) followed by array columns:
+    block page numbers uint32[blocks], rects float32[blocks * 4], text offsets uint32[blocks + 1] into the
+    UTF-8 text blob that ends the file. Numbers are little endian; every column is 4 byte aligned so the columns
+    are read straight from the mapping.
+    """
+    MAGIC = b"PDFLAY01"
+    HEADER = struct.Struct("<8sIII")
+
+    @classmethod
+    def write(cls, path, page_index):
+        page_numbers, rects, offsets, texts = array("I"), array("f"), array("I", [0]), []
+        blob_size = 0
+        for text_blocks in page_index:
+            for block in text_blocks:
+                encoded_text = block.text.encode('utf-8')
+                page_numbers.append(block.page_number)
+                rects.extend(block.rect)
+                texts.append(encoded_text)
+                blob_size += len(encoded_text)
+                offsets.append(blob_size)
+        columns = (page_numbers, rects, offsets)
+        if sys.byteorder != "little":
+            for column in columns:
+                column.byteswap()
+
+        # Write then rename so a reader never maps a partial index
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'wb') as index_file:
+            index_file.write(cls.HEADER.pack(cls.MAGIC, len(page_index), len(page_numbers), blob_size))
+            for column in columns:
+                column.tofile(index_file)
+            index_file.write(b"".join(texts))
+        os.replace(temp_path, path)
+
+    def __init__(self, path):
+        with open(path, 'rb') as index_file:
+            self.mapping = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.page_count, block_count, blob_size = self.HEADER.unpack_from(self.mapping)
+        if magic != self.MAGIC:
+            self.mapping.close()
+            raise ValueError(f"{path} is not a layout index")
+
+        view = memoryview(self.mapping)
+        position = self.HEADER.size
+        columns = []
+        for type_code, length in (("I", block_count), ("f", block_count * 4), ("I", block_count + 1)):
+            size = length * 4
+            columns.append(view[position:position + size].cast(type_code))
+            position += size
+        self.page_numbers, self.rects, self.offsets = columns
+        self.blob = view[position:position + blob_size]
+        if sys.byteorder != "little":  # The columns are little endian on disk - swap a copy
+            self.page_numbers, self.rects, self.offsets = (array(column.format, column) for column in columns)
+            for column in (self.page_numbers, self.rects, self.offsets):
+                column.byteswap()
+
+    def page_index(self):
+        """List (indexed by page number) of TextBlock lists, the same as SplitPdf.build_page_index"""
+        page_index = [[] for _ in range(self.page_count)]
+        rects, offsets, blob = self.rects, self.offsets, self.blob
+        for block_number, page_number in enumerate(self.page_numbers):
+            text = str(blob[offsets[block_number]:offsets[block_number + 1]], 'utf-8')
+            rect = tuple(rects[block_number * 4:block_number * 4 + 4])
+            page_index[page_number].append(TextBlock(page_number, text, rect, text.lower()))
+        return page_index
+
+    def close(self):
+        for column in (self.page_numbers, self.rects, self.offsets, self.blob):
+            if isinstance(column, memoryview):
+                column.release()
+        self.mapping.close()
+
+
+class PhraseAutomaton:
+    """
+    Aho-Corasick automaton over a fixed list of phrases.
+    search(text) returns the ids of every phrase contained in text (case sensitive, same as `phrase in text`) in one scan.
+    """
+    def __init__(self, phrases):
+        self.transitions = [{}]
+        self.fail = [0]
+        self.outputs = [set()]
+
+        # Build the trie of all phrases
+        for phrase_id, phrase in enumerate(phrases):
+            state = 0
+            for char in phrase:
+                next_state = self.transitions[state].get(char)
+                if next_state is None:
+                    next_state = len(self.transitions)
+                    self.transitions[state][char] = next_state
+                    self.transitions.append({})
+                    self.fail.append(0)
+                    self.outputs.append(set())
+                state = next_state
+            self.outputs[state].add(phrase_id)
+
+        # Breadth first fill of the failure links (depth 1 states fail back to the root)
+        queue = deque(self.transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.transitions[state].items():
+                queue.append(next_state)
+                fail_state = self.fail[state]
+                while fail_state and char not in self.transitions[fail_state]:
+                    fail_state = self.fail[fail_state]
+                self.fail[next_state] = self.transitions[fail_state].get(char, 0)
+                self.outputs[next_state] |= self.outputs[self.fail[next_state]]
+
+    def search(self, text):
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in self.transitions[state]:
+                state = self.fail[state]
+            state = self.transitions[state].get(char, 0)
+            if self.outputs[state]:
+                found |= self.outputs[state]
+        return found
+
+
+def could_reach_ratio(phrase, text, threshold):
+    """
+    Cheap upper bounds of fuzz.ratio(phrase, text) - False means the full ratio can't reach threshold.
+    The length bound 2 * min / (len + len) and the character count bound (quick_ratio) hold for both
+    fuzzywuzzy's difflib and python-Levenshtein backends.
+    """
+    if threshold <= 0:
+        return True
+    total_length = len(phrase) + len(text)
+    if not total_length or round(200 * min(len(phrase), len(text)) / total_length) < threshold:
+        return False
+    from difflib import SequenceMatcher
+    return round(100 * SequenceMatcher(None, phrase, text).quick_ratio()) >= threshold
+
+
+def fuzz_ratio(phrase, text):
+    """fuzz.ratio, importing fuzzywuzzy on first use - a split whose phrases all match exactly never loads it"""
+    from fuzzywuzzy import fuzz
+    return fuzz.ratio(phrase, text)
+
+
+""" Spelling variants of the section titles - OCR and form revisions differ in dashes, quotes and a few words"""
+PHRASE_CHARACTER_FOLDS = str.maketrans({"—": "-", "–": "-", "‐": "-", "‑": "-", "’": "'", "‘": "'", "“": '"', "”": '"'})
+PHRASE_VARIANTS = (("gainassets", "gain assets"), ("(FDII)", "(FDI)"), (" - ", "-"))
+
+
+@lru_cache(maxsize=4096)  # The legacy search normalizes each block once per section and phrase list
+def normalize_phrase(text):
+    """
+    Form of a phrase or block text that exact matching compares - dashes and quotes folded and the PHRASE_VARIANTS
+    spellings replaced, so "(FDI)"/"(FDII)" are one phrase. Whitespace is kept as it is: a trailing space in a
+    phrase tells a title apart from the same words ending a line of another section's text.
+    """
+    normalized = text.translate(PHRASE_CHARACTER_FOLDS)
+    for variant, canonical in PHRASE_VARIANTS:
+        normalized = normalized.replace(variant, canonical)
+    return normalized
+
+
+class PhraseTable:
+    """
+    Every start/end phrase of the section definitions, interned once per SplitPdf and shared by its matchers.
+
+    Per phrase id it keeps the normalize_phrase form exact matching looks for, the lowercased text fuzz.ratio
+    compares against and the id of the first phrase with the same lowercased text, so duplicates share one
+    comparison. Fuzzy scores use the phrase as written (lowercased) - normalizing it would change them.
+    """
+    def __init__(self):
+        self.phrases = []
+        self.phrase_ids = {}
+        self.normalized = []
+        self.lowered = []
+        self.lowered_ids = []  # phrase id -> first phrase id with the same lowered text
+        self.first_with_lowered = {}
+
+    def intern(self, texts):
+        """Phrase ids of texts, adding the ones not seen before"""
+        ids = []
+        for text in texts:
+            if text not in self.phrase_ids:
+                phrase_id = len(self.phrases)
+                self.phrase_ids[text] = phrase_id
+                self.phrases.append(text)
+                self.normalized.append(normalize_phrase(text))
+                self.lowered.append(text.lower())
+                self.lowered_ids.append(self.first_with_lowered.setdefault(self.lowered[phrase_id], phrase_id))
+            ids.append(self.phrase_ids[text])
+        return tuple(ids)
+
+
+class BlockMatch:
+    """
+    Phrase hits of one text block - exact hits from one automaton scan, fuzzy hits evaluated lazily and memoized
+    so every section asking about the same block and phrase shares one comparison.
+    """
+    def __init__(self, matcher, block):
+        self.matcher = matcher
+        self.normalized_text = block.normalized_text
+        self.exact_hits = matcher.automaton.search(normalize_phrase(block.text))
+        self.fuzzy_hits = {}
+
+    def exact(self, ids, count=True):
+        if self.exact_hits.intersection(ids):
+            if count:
+                self.matcher.metrics.count("exact_matches")
+            return True
+        return False
+
+    def fuzzy(self, ids, count=True):
+        for phrase_id in ids:
+            lowered_id = self.matcher.phrase_table.lowered_ids[phrase_id]  # Same lowered text, same ratio
+            if lowered_id not in self.fuzzy_hits:
+                self.fuzzy_hits[lowered_id] = self.matcher.fuzzy_ratio_matches(lowered_id, self.normalized_text)
+            if self.fuzzy_hits[lowered_id]:
+                if count:
+                    self.matcher.metrics.count("fuzzy_matches")
+                return True
+        return False
+
+    def matches(self, ids, count=True):
+        """
+        Exact match first, fuzzy fallback - same as find_exact_match(...) or find_fuzzy_match(...)
+        count=False leaves the exact/fuzzy match counters alone, for checks that don't place a boundary.
+        """
+        return self.exact(ids, count) or self.fuzzy(ids, count)
+
+
+class BoundaryMatcher:
+    """
+    Compiled matcher for the start/end phrases of every section at once.
+
+    Exact hits for all phrases come from one PhraseAutomaton scan per block, both in their normalize_phrase form
+    like SplitPdf.find_exact_match. The fuzzy fallback is evaluated lazily, once per (block, phrase), and rejects
+    pairs whose length or character counts mean fuzz.ratio can never reach the threshold before running the full
+    ratio - so results are the same as SplitPdf.find_fuzzy_match.
+    """
+    RESERVED_TEXT = "Reserved for Future Use"
+    SECTION_ENDS = ("last", "first")
+    SECTION_SEARCHES = ("independent", "ordered")
+
+    def __init__(self, sections, threshold=90, metrics=None, section_end="last", phrase_table=None):
+        """
+        :param sections: Dict of section name -> list of (start_texts, end_texts), as used by find_section_ranges.
+        :param threshold: fuzz.ratio score needed for a fuzzy match.
+        :param metrics: Metrics to count exact/fuzzy boundary matches in.
+        :param phrase_table: PhraseTable to intern the phrases in (e.g. the SplitPdf's, a new one if None).
+        :param section_end: "last" ends a section on the last page with an end text after its start (the
+                            find_section_ranges rule), "first" on the first one - which lets a streaming run
+                            emit the section as soon as that page is seen.
+        """
+        if section_end not in self.SECTION_ENDS:
+            raise ValueError(f"section_end must be one of {self.SECTION_ENDS}, got '{section_end}'")
+        self.threshold = threshold
+        self.section_end = section_end
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.phrase_table = phrase_table if phrase_table is not None else PhraseTable()
+        self.block_matches = {}  # (page_number, block number) -> BlockMatch
+
+        # name -> list of (start_texts, end_texts, start_ids, end_ids)
+        intern = self.phrase_table.intern
+        self.sections = {
+            name: [(start_texts, end_texts, intern(start_texts), intern(end_texts)) for start_texts, end_texts in entries]
+            for name, entries in sections.items()
+        }
+        self.reserved_ids = intern([self.RESERVED_TEXT])
+        self.automaton = PhraseAutomaton(self.phrase_table.normalized)
+
+    def fuzzy_ratio_matches(self, phrase_id, normalized_text):
+        phrase = self.phrase_table.lowered[phrase_id]
+        if phrase == normalized_text:
+            return True
+        if not could_reach_ratio(phrase, normalized_text, self.threshold):
+            return False
+        return fuzz_ratio(phrase, normalized_text) >= self.threshold
+
+    def ids_of(self, texts):
+        """Phrase ids of texts that were part of the sections the matcher was built with"""
+        return tuple(self.phrase_table.phrase_ids[text] for text in texts)
+
+    def finds_start(self, page_index, name):
+        """True if a start text of section name is on any page of page_index, whether or not it has a valid range"""
+        return any(self.match_block(block, block_number).matches(start_ids, count=False)
+                   for _, _, start_ids, _ in self.sections[name]
+                   for text_blocks in page_index for block_number, block in enumerate(text_blocks))
+
+    def match_block(self, block, block_number):
+        """The (memoized) BlockMatch of a page index block"""
+        key = (block.page_number, block_number)
+        if key not in self.block_matches:
+            self.block_matches[key] = BlockMatch(self, block)
+        return self.block_matches[key]
+
+    def find_crop_rect(self, text_blocks, start_ids, end_ids):
+        """
+        Rect of a page from the first found start text to the first found end text (None if no match),
+        same rules as SplitPdf.find_crop_rect.
+        """
+        crop_boxes = []
+        cropping = False
+        for block_number, block in enumerate(text_blocks):
+            block_match = self.match_block(block, block_number)
+            if block_match.matches(start_ids):
+                cropping = True
+                crop_boxes.append(block.rect)
+            if cropping:
+                crop_boxes.append(block.rect)
+            if block_match.matches(end_ids):
+                crop_boxes.append(block.rect)
+                break
+
+        if not crop_boxes:
+            return None
+        return fitz.Rect(min(box[0] for box in crop_boxes), min(box[1] for box in crop_boxes),
+                         max(box[2] for box in crop_boxes), max(box[3] for box in crop_boxes))
+
+    def find_section_ranges(self, page_index):
+        """
+        Scan the page index once and return a dict of section name -> list of (start_texts, start_page, end_page),
+        using the same rules as SplitPdf.find_section_ranges for every section.
+        """
+        scan = SectionScan(self)
+        for page_number, text_blocks in enumerate(page_index):
+            scan.feed(page_number, text_blocks)
+        return scan.ranges()
+
+    def find_ordered_section_ranges(self, page_index):
+        """
+        Section ordered search, for documents whose sections appear in the order of self.sections (the K-3 parts do).
+        One forward pass over the document: each section is searched from where the previous section's search
+        stopped, and its scan stops at the first end text after its start or after the first page with the start
+        text of a later section. A section skipped that way (no start before a later section's start) is absent,
+        so the whole search reads about one page per page of the document plus one per section.
+        Ranges end on the first end text (section_end "first"), with the same "Reserved for Future Use" fallback.
+
+        :return: Dict of section name -> list of (start_texts, start_page, end_page), like find_section_ranges.
+        """
+        ranges = {}
+        names = list(self.sections)
+        resume_page = 0
+        for position, name in enumerate(names):
+            later_start_ids = tuple(phrase_id for later_name in names[position + 1:]
+                                    for _, _, start_ids, _ in self.sections[later_name] for phrase_id in start_ids)
+            ranges[name] = []
+            next_page = None
+            for start_texts, end_texts, start_ids, end_ids in self.sections[name]:
+                found, stop_page = self.scan_entry(page_index, resume_page, start_ids, end_ids, later_start_ids)
+                # The next section goes on from the furthest page an entry of this one reached
+                next_page = stop_page if next_page is None else max(next_page, stop_page)
+                if found is None:
+                    self.metrics.log("Could not find valid range for start '%s' and end texts %s", start_texts, end_texts)
+                    continue
+                ranges[name].append((start_texts,) + found)
+            resume_page = next_page
+        return ranges
+
+    def scan_entry(self, page_index, first_page, start_ids, end_ids, later_start_ids=()):
+        """
+        Search one section entry from first_page.
+
+        :param later_start_ids: Start phrases of the later sections - the scan stops after the first page (past the
+                                entry's start page) that has one of them.
+        :return: ((start_page, end_page) or None if it has no valid range, page the scan stopped on).
+        """
+        start_page = potential_end_page = None
+        for page_number in range(first_page, len(page_index)):
+            self.metrics.count("range_pages_scanned")
+            later_start_found = False
+            for block_number, block in enumerate(page_index[page_number]):
+                block_match = self.match_block(block, block_number)
+                if start_page is None and block_match.matches(start_ids):
+                    start_page = page_number
+
+                if start_page is not None:
+                    if block_match.exact_hits.intersection(self.reserved_ids):
+                        potential_end_page = page_number
+                    if block_match.matches(end_ids):
+                        return (start_page, page_number), page_number  # End confirmed - stop here
+                if not later_start_found and later_start_ids and block_match.matches(later_start_ids, count=False):
+                    later_start_found = True
+
+            if later_start_found and (start_page is None or page_number > start_page):
+                break  # A later section has started, this one won't start or end after it
+        else:
+            page_number = len(page_index)
+
+        if start_page is not None and potential_end_page is not None:
+            return (start_page, potential_end_page), page_number  # Fallback to "Reserved for Future Use"
+        return None, page_number
+
+
+class SectionScan:
+    """
+    Incremental section range search of a BoundaryMatcher - pages are fed in order as they become available.
+    With the matcher's section_end "first" feed() reports the sections whose ranges can no longer change,
+    so they can be split before the rest of the document exists.
+    """
+    def __init__(self, matcher):
+        self.matcher = matcher
+        # One independent search state per (section, entry): [start_page, end_page, potential_end_page]
+        self.states = {name: [[None, None, None] for _ in entries] for name, entries in matcher.sections.items()}
+        self.final = set()  # Sections already reported by feed
+
+    def feed(self, page_number, text_blocks):
+        """
+        Match the blocks of the next page.
+
+        :return: Names of the sections whose ranges became final on this page (always empty with section_end "last",
+                 where a later end text can still move the end).
+        """
+        first_end = self.matcher.section_end == "first"
+        # Entries whose end text was found on this page stop looking at the rest of the page
+        finished_on_page = set()
+
+        for block_number, block in enumerate(text_blocks):
+            block_match = self.matcher.match_block(block, block_number)
+
+            for name, entries in self.matcher.sections.items():
+                if name in self.final:
+                    continue
+                for entry_number, (_, _, start_ids, end_ids) in enumerate(entries):
+                    if (name, entry_number) in finished_on_page:
+                        continue
+                    state = self.states[name][entry_number]
+                    if first_end and state[1] is not None:
+                        continue
+
+                    if state[0] is None and block_match.matches(start_ids):
+                        state[0] = page_number
+
+                    if state[0] is not None:
+                        if block_match.exact_hits.intersection(self.matcher.reserved_ids):
+                            state[2] = page_number
+                        if block_match.matches(end_ids):
+                            state[1] = page_number
+                            finished_on_page.add((name, entry_number))
+
+        if not first_end:
+            return []
+        now_final = [name for name in self.matcher.sections
+                     if name not in self.final and all(state[1] is not None for state in self.states[name])]
+        self.final.update(now_final)
+        return now_final
+
+    def section_ranges(self, name):
+        """List of (start_texts, start_page, end_page) of one section from the pages fed so far"""
+        ranges = []
+        for (start_texts, end_texts, _, _), (start_page, end_page, potential_end_page) in zip(
+                self.matcher.sections[name], self.states[name]):
+            if start_page is not None and (end_page is not None or potential_end_page is not None):
+                # Use the actual end if found, or fallback to "Reserved for Future Use"
+                final_end_page = end_page if end_page is not None else potential_end_page
+                if start_page <= final_end_page:
+                    ranges.append((start_texts, start_page, final_end_page))
+            else:
+                self.matcher.metrics.log("Could not find valid range for start '%s' and end texts %s",
+                                         start_texts, end_texts)
+        return ranges
+
+    def ranges(self):
+        """Dict of section name -> section_ranges(name) once every page has been fed"""
+        return {name: self.section_ranges(name) for name in self.matcher.sections}
+
+
+""" Start and end texts to split by section - if start has more than one value it will iterate until value found.
+Each section is a tuple of (start texts, end texts) entries, built once at import and shared by every SplitPdf."""
+K1_FORM = (
+    (
+        ("Schedule K-1 ",),
+        ("For Paperwork Reduction Act Notice, see the Instructions for Form 1065.",),
+    ),
+)
+
+K3_TITLE_PAGE = (
+    (
+        ("Credits, etc.—International", "Credits, etc.-International ", "Credits, etc. - International"),
+        ("For Paperwork Reduction Act Notice, see the Instructions for Form 1065.",),
+    ),
+)
+
+PART_1 = (
+    (
+        ("Check box(es) for additional specified attachments. See instructions.",),
+        ("13. Other international items",),
+    ),
+)
+
+PART_2 = (
+    (
+        ("Foreign Tax Credit Limitation", "Foreign Tax Credit Limitation (continued)"),
+        (
+            "Other Information for Preparation of Form 1116 or 1118",
+            "Information on Partner’s Section 250 Deduction With Respect to Foreign-Derived Intangible Income (FDI)",
+            "Information on Partner’s Section 951(a)(1) and Section 951A Inclusions",
+            "Distributions From Foreign Corporations to Partnership",
+            "Information Regarding Passive Foreign Investment Companies (PFICs)",
+            "Partner’s Interest in Foreign Corporation Income (Section 960)",
+            "Partner’s Information for Base Erosion and Anti-Abuse Tax (Section 59A)",
+            "Foreign Partner’s Character and Source of Income and Deductions",
+            "Section 871(m) Covered Partnerships",
+            "Reserved for Future Use",
+            "Gain that would be recognized under section 897(g) on the deemed sale of section 1(h)(6) unrecaptured section 1250 gain assets.",
+        ),
+    ),
+)
+
+PART_3 = (
+    (
+        (
+            "Other Information for Preparation of Form 1116 or 1118",
+            "Other Information for Preparation of Form 1116 or 1118 (continued)",
+        ),
+        (
             "Information on Partner’s Section 250 Deduction With Respect to Foreign-Derived Intangible Income (FDII)",
-                "Distributions From Foreign Corporations to Partnership",
-                "Information on Partner’s Section 951(a)(1) and Section 951A Inclusions",        
-                "Information Regarding Passive Foreign Investment Companies (PFICs)",
-                "Information Regarding Passive Foreign Investment Companies (PFICs) (continued)",
-                "Partner’s Interest in Foreign Corporation Income (Section 960) ",
-                "Partner’s Interest in Foreign Corporation Income (Section 960) (continued)",
-                "Partner’s Information for Base Erosion and Anti-Abuse Tax (Section 59A)",
-                "Partner’s Information for Base Erosion and Anti-Abuse Tax (Section 59A) (continued)",
-                "Foreign Partner’s Character and Source of Income and Deductions",
-                "Foreign Partner’s Character and Source of Income and Deductions (continued)",
-                "Section 871(m) Covered Partnerships",
-                "Reserved for Future Use",
-                "Gain that would be recognized under section 897(g) on the deemed sale of section 1(h)(6) unrecaptured section 1250 gain assets."
-            ])
-        ]
- 
-        self._4 = [
-                (["Information on Partner’s Section 250 Deduction With Respect to Foreign-Derived Intangible Income (FDII) ", "Information on Partner’s Section 250 Deduction With Respect to Foreign-Derived Intangible Income (FDI) "],
-                [
-                    "Distributions From Foreign Corporations to Partnership",
-                    "Information on Partner’s Section 951(a)(1) and Section 951A Inclusions",
-                    "Information Regarding Passive Foreign Investment Companies (PFICs)",
-                    "Partner’s Interest in Foreign Corporation Income (Section 960)",
-                    "Partner’s Information for Base Erosion and Anti-Abuse Tax (Section 59A)",
-                    "Foreign Partner’s Character and Source of Income and Deductions",
-                    "Section 871(m) Covered Partnerships",
-                    "Reserved for Future Use",
-                    "Gain that would be recognized under section 897(g) on the deemed sale of section 1(h)(6) unrecaptured section 1250 gain assets."
-                ])
-            ]
- 
-        self._5 = [
-                (["Distributions From Foreign Corporations to Partnership"],
-                [
-                    "Information on Partner’s Section 951(a)(1) and Section 951A Inclusions",
-                    "Information Regarding Passive Foreign Investment Companies (PFICs)",
-                    "Partner’s Interest in Foreign Corporation Income (Section 960)",
-                    "Partner’s Information for Base Erosion and Anti-Abuse Tax (Section 59A)",
-                    "Foreign Partner’s Character and Source of Income and Deductions",
-                    "Section 871(m) Covered Partnerships",
-                    "Reserved for Future Use",
-                    "Gain that would be recognized under section 897(g) on the deemed sale of section 1(h)(6) unrecaptured section 1250 gain assets."
-                ])
-            ]
- 
-        self._6 = [
-            (["Information on Partner’s Section 951(a)(1) and Section 951A Inclusions", "Information Regarding Passive Foreign Investment Companies (PFICs) (continued)"],
-            [
-                "Information Regarding Passive Foreign Investment Companies (PFICs)",
-                "Information Regarding Passive Foreign Investment Companies (PFICs) (continued)",
-                "Partner’s Interest in Foreign Corporation Income (Section 960) ",
-                "Partner’s Interest in Foreign Corporation Income (Section 960) (continued)",
-                "Partner’s Information for Base Erosion and Anti-Abuse Tax (Section 59A)",
-                "Partner’s Information for Base Erosion and Anti-Abuse Tax (Section 59A) (continued)",
-                "Foreign Partner’s Character and Source of Income and Deductions",
-                "Foreign Partner’s Character and Source of Income and Deductions (continued)",
-                "Section 871(m) Covered Partnerships",
-                "Reserved for Future Use",
-                "Gain that would be recognized under section 897(g) on the deemed sale of section 1(h)(6) unrecaptured section 1250 gain assets."
-            ])
-        ]
- 
-        self._7 = [
-        (["Information Regarding Passive Foreign Investment Companies (PFICs)", "Information Regarding Passive Foreign Investment Companies (PFICs) (continued)"],
-        [
-           "Partner’s Interest in Foreign Corporation Income (Section 960) ",
+            "Distributions From Foreign Corporations to Partnership",
+            "Information on Partner’s Section 951(a)(1) and Section 951A Inclusions",
+            "Information Regarding Passive Foreign Investment Companies (PFICs)",
+            "Information Regarding Passive Foreign Investment Companies (PFICs) (continued)",
+            "Partner’s Interest in Foreign Corporation Income (Section 960) ",
             "Partner’s Interest in Foreign Corporation Income (Section 960) (continued)",
             "Partner’s Information for Base Erosion and Anti-Abuse Tax (Section 59A)",
             "Partner’s Information for Base Erosion and Anti-Abuse Tax (Section 59A) (continued)",
@@ -223,150 +1442,404 @@ class SplitPdf:
             "Foreign Partner’s Character and Source of Income and Deductions (continued)",
             "Section 871(m) Covered Partnerships",
             "Reserved for Future Use",
-            "Gain that would be recognized under section 897(g) on the deemed sale of section 1(h)(6) unrecaptured section 1250 gain assets."
-        ])
-    ]
- 
-        self._8 = [
-            (["Partner’s Interest in Foreign Corporation Income (Section 960)", "Partner’s Interest in Foreign Corporation Income (Section 960) (continued)" ],
-            [
-                "Partner’s Information for Base Erosion and Anti-Abuse Tax (Section 59A)",
-                "Partner’s Information for Base Erosion and Anti-Abuse Tax (Section 59A) (continued)",
-                "Foreign Partner’s Character and Source of Income and Deductions",
-                "Foreign Partner’s Character and Source of Income and Deductions (continued)",
-                "Section 871(m) Covered Partnerships",
-                "Reserved for Future Use",
-                "Gain that would be recognized under section 897(g) on the deemed sale of section 1(h)(6) unrecaptured section 1250 gain assets."
-            ])
-        ]
- 
-        self._9 = [
-            (["Partner’s Information for Base Erosion and Anti-Abuse Tax (Section 59A) ", "Partner’s Information for Base Erosion and Anti-Abuse Tax (Section 59A) (continued)"],
-            [
-                "Foreign Partner’s Character and Source of Income and Deductions ",
-                "Foreign Partner’s Character and Source of Income and Deductions (continued) ",
-                "Section 871(m) Covered Partnerships",
-                "Reserved for Future Use",
-                "Gain that would be recognized under section 897(g) on the deemed sale of section 1(h)(6) unrecaptured section 1250 gain assets."
-            ])
-            ]
- 
-        self._10 =[
-            (["Foreign Partner’s Character and Source of Income and Deductions ", "Foreign Partner’s Character and Source of Income and Deductions (continued) "],
-            ["Section 871(m) Covered Partnerships",
-                "Reserved for Future Use",
-                "Gain that would be recognized under section 897(g) on the deemed sale of section 1(h)(6) unrecaptured section 1250 gainassets."
-            ])
-        ]
- 
-        self._11 = [
-            (["Section 871(m) Covered Partnerships"],
-            [
-                "Reserved for Future Use"
-            ])
-        ]  
+            "Gain that would be recognized under section 897(g) on the deemed sale of section 1(h)(6) unrecaptured section 1250 gain assets.",
+        ),
+    ),
+)
+
+PART_4 = (
+    (
+        (
+            "Information on Partner’s Section 250 Deduction With Respect to Foreign-Derived Intangible Income (FDII) ",
+            "Information on Partner’s Section 250 Deduction With Respect to Foreign-Derived Intangible Income (FDI) ",
+        ),
+        (
+            "Distributions From Foreign Corporations to Partnership",
+            "Information on Partner’s Section 951(a)(1) and Section 951A Inclusions",
+            "Information Regarding Passive Foreign Investment Companies (PFICs)",
+            "Partner’s Interest in Foreign Corporation Income (Section 960)",
+            "Partner’s Information for Base Erosion and Anti-Abuse Tax (Section 59A)",
+            "Foreign Partner’s Character and Source of Income and Deductions",
+            "Section 871(m) Covered Partnerships",
+            "Reserved for Future Use",
+            "Gain that would be recognized under section 897(g) on the deemed sale of section 1(h)(6) unrecaptured section 1250 gain assets.",
+        ),
+    ),
+)
+
+PART_5 = (
+    (
+        ("Distributions From Foreign Corporations to Partnership",),
+        (
+            "Information on Partner’s Section 951(a)(1) and Section 951A Inclusions",
+            "Information Regarding Passive Foreign Investment Companies (PFICs)",
+            "Partner’s Interest in Foreign Corporation Income (Section 960)",
+            "Partner’s Information for Base Erosion and Anti-Abuse Tax (Section 59A)",
+            "Foreign Partner’s Character and Source of Income and Deductions",
+            "Section 871(m) Covered Partnerships",
+            "Reserved for Future Use",
+            "Gain that would be recognized under section 897(g) on the deemed sale of section 1(h)(6) unrecaptured section 1250 gain assets.",
+        ),
+    ),
+)
+
+PART_6 = (
+    (
+        (
+            "Information on Partner’s Section 951(a)(1) and Section 951A Inclusions",
+            "Information Regarding Passive Foreign Investment Companies (PFICs) (continued)",
+        ),
+        (
+            "Information Regarding Passive Foreign Investment Companies (PFICs)",
+            "Information Regarding Passive Foreign Investment Companies (PFICs) (continued)",
+            "Partner’s Interest in Foreign Corporation Income (Section 960) ",
+            "Partner’s Interest in Foreign Corporation Income (Section 960) (continued)",
+            "Partner’s Information for Base Erosion and Anti-Abuse Tax (Section 59A)",
+            "Partner’s Information for Base Erosion and Anti-Abuse Tax (Section 59A) (continued)",
+            "Foreign Partner’s Character and Source of Income and Deductions",
+            "Foreign Partner’s Character and Source of Income and Deductions (continued)",
+            "Section 871(m) Covered Partnerships",
+            "Reserved for Future Use",
+            "Gain that would be recognized under section 897(g) on the deemed sale of section 1(h)(6) unrecaptured section 1250 gain assets.",
+        ),
+    ),
+)
+
+PART_7 = (
+    (
+        (
+            "Information Regarding Passive Foreign Investment Companies (PFICs)",
+            "Information Regarding Passive Foreign Investment Companies (PFICs) (continued)",
+        ),
+        (
+            "Partner’s Interest in Foreign Corporation Income (Section 960) ",
+            "Partner’s Interest in Foreign Corporation Income (Section 960) (continued)",
+            "Partner’s Information for Base Erosion and Anti-Abuse Tax (Section 59A)",
+            "Partner’s Information for Base Erosion and Anti-Abuse Tax (Section 59A) (continued)",
+            "Foreign Partner’s Character and Source of Income and Deductions",
+            "Foreign Partner’s Character and Source of Income and Deductions (continued)",
+            "Section 871(m) Covered Partnerships",
+            "Reserved for Future Use",
+            "Gain that would be recognized under section 897(g) on the deemed sale of section 1(h)(6) unrecaptured section 1250 gain assets.",
+        ),
+    ),
+)
+
+PART_8 = (
+    (
+        (
+            "Partner’s Interest in Foreign Corporation Income (Section 960)",
+            "Partner’s Interest in Foreign Corporation Income (Section 960) (continued)",
+        ),
+        (
+            "Partner’s Information for Base Erosion and Anti-Abuse Tax (Section 59A)",
+            "Partner’s Information for Base Erosion and Anti-Abuse Tax (Section 59A) (continued)",
+            "Foreign Partner’s Character and Source of Income and Deductions",
+            "Foreign Partner’s Character and Source of Income and Deductions (continued)",
+            "Section 871(m) Covered Partnerships",
+            "Reserved for Future Use",
+            "Gain that would be recognized under section 897(g) on the deemed sale of section 1(h)(6) unrecaptured section 1250 gain assets.",
+        ),
+    ),
+)
+
+PART_9 = (
+    (
+        (
+            "Partner’s Information for Base Erosion and Anti-Abuse Tax (Section 59A) ",
+            "Partner’s Information for Base Erosion and Anti-Abuse Tax (Section 59A) (continued)",
+        ),
+        (
+            "Foreign Partner’s Character and Source of Income and Deductions ",
+            "Foreign Partner’s Character and Source of Income and Deductions (continued) ",
+            "Section 871(m) Covered Partnerships",
+            "Reserved for Future Use",
+            "Gain that would be recognized under section 897(g) on the deemed sale of section 1(h)(6) unrecaptured section 1250 gain assets.",
+        ),
+    ),
+)
+
+PART_10 = (
+    (
+        (
+            "Foreign Partner’s Character and Source of Income and Deductions ",
+            "Foreign Partner’s Character and Source of Income and Deductions (continued) ",
+        ),
+        (
+            "Section 871(m) Covered Partnerships",
+            "Reserved for Future Use",
+            "Gain that would be recognized under section 897(g) on the deemed sale of section 1(h)(6) unrecaptured section 1250 gainassets.",
+        ),
+    ),
+)
+
+PART_11 = (
+    (
+        ("Section 871(m) Covered Partnerships",),
+        ("Reserved for Future Use",),
+    ),
+)
+
+#We don't use section 12 so skipped
+PART_13 = (
+    (
+        (
+            "Foreign Partner’s Distributive Share of Deemed Sale Items on Transfer of Partnership Interest",
+            "Total ordinary gain (loss) that would be recognized on the deemed sale of section 751 property",
+        ),
+        (
+            "Gain that would be recognized under section 897(g) on the deemed sale of section 1(h)(6) unrecaptured section 1250 gainassets",
+            "Gain that would be recognized under section 897(g) on the deemed sale of section 1(h)(6) unrecaptured section 1250 gain assets",
+        ),
+    ),
+)
+
+""" Sections to split and their output file names """
+SECTIONS = MappingProxyType({
+    "K1": K1_FORM,
+    "K3 Title Page": K3_TITLE_PAGE,
+    "Part 1": PART_1,
+    "Part 2": PART_2,
+    "Part 3": PART_3,
+    "Part 4": PART_4,
+    "Part 5": PART_5,
+    "Part 6": PART_6,
+    "Part 7": PART_7,
+    "Part 8": PART_8,
+    "Part 9": PART_9,
+    "Part 10": PART_10,
+    "Part 11": PART_11,
+    "Part 13": PART_13,
+})
+
+""" Class for splitting the output selectable ocr pdf into sections for the K3 Tax Document"""
+class SplitPdf:
+    CROP_MODES = ("vector", "raster")
+    # The section definitions, see SECTIONS
+    K1_form = K1_FORM
+    K3_title_page = K3_TITLE_PAGE
+    _1 = PART_1
+    _2 = PART_2
+    _3 = PART_3
+    _4 = PART_4
+    _5 = PART_5
+    _6 = PART_6
+    _7 = PART_7
+    _8 = PART_8
+    _9 = PART_9
+    _10 = PART_10
+    _11 = PART_11
+    _13 = PART_13
+
+    def __init__(self, pdf_document, output_folder, crop_mode="vector", metrics=None, save_workers=1,
+                 section_end="last", section_search="independent", document_name=None, parts=None,
+                 layout_index_path=None):
+        """
+        :param pdf_document: Path to the text-based (OCR'd) PDF to split, or an open fitz document.
+        :param output_folder: Directory where the section folders will be saved.
+        :param crop_mode: "vector" keeps the cropped pages as selectable PDF content, "raster" saves them as images.
+        :param metrics: Metrics to record timings and counters in (a new one if None).
+        :param save_workers: Number of processes writing section PDFs at once (1 = write them serially in this process).
+        :param section_end: Which end text match ends a section, see BoundaryMatcher.
+        :param section_search: "independent" searches every section over the whole document, "ordered" searches
+                               the sections in order in one forward pass, each from where the previous one's
+                               search stopped (see BoundaryMatcher.find_ordered_section_ranges).
+        :param document_name: Name of the document's section folder (default: the document's path).
+        :param parts: Names of the sections to split, e.g. ["Part 2", "Part 3"] (None = every section).
+        :param layout_index_path: LayoutIndex of this document to load the page index from instead of parsing it.
+        """
+        if crop_mode not in self.CROP_MODES:
+            raise ValueError(f"crop_mode must be one of {self.CROP_MODES}, got '{crop_mode}'")
+        if section_search not in BoundaryMatcher.SECTION_SEARCHES:
+            raise ValueError(f"section_search must be one of {BoundaryMatcher.SECTION_SEARCHES}, got '{section_search}'")
+        self.pdf_document = pdf_document if isinstance(pdf_document, fitz.Document) else fitz.open(pdf_document)
+        self.document_name = document_name if document_name is not None else self.pdf_document.name
+        self.output_folder = output_folder
+        self.crop_mode = crop_mode
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.save_workers = max(1, save_workers)
+        self.section_end = section_end
+        self.section_search = section_search
+        self.parts = parts
+        self.layout_index_path = layout_index_path
+        self.page_index = None  # Built once on first use - see build_page_index
  
-        #We don't use section 12 so skipped
-       
-        self._13 =   [
-        (["Foreign Partner’s Distributive Share of Deemed Sale Items on Transfer of Partnership Interest", "Total ordinary gain (loss) that would be recognized on the deemed sale of section 751 property"],
-        [
-            "Gain that would be recognized under section 897(g) on the deemed sale of section 1(h)(6) unrecaptured section 1250 gainassets", "Gain that would be recognized under section 897(g) on the deemed sale of section 1(h)(6) unrecaptured section 1250 gain assets"
-        ])
-        ]
+        # Every start/end phrase normalized and lowercased once, shared by the find_*_match methods and the matchers
+        self.phrase_table = PhraseTable()
+        for entries in self.get_sections().values():
+            for start_texts, end_texts in entries:
+                self.phrase_table.intern(start_texts)
+                self.phrase_table.intern(end_texts)
  
+    def get_sections(self):
+        """ Sections to split and their output file names (the read-only SECTIONS mapping) """
+        return SECTIONS
+
+    def selected_sections(self):
+        """get_sections limited to the parts this splitter was asked for"""
+        sections = self.get_sections()
+        if self.parts is None:
+            return sections
+        unknown_parts = [name for name in self.parts if name not in sections]
+        if unknown_parts:
+            raise ValueError(f"Unknown parts {unknown_parts}, expected names from {list(sections)}")
+        return {name: entries for name, entries in sections.items() if name in self.parts}
+
+    def build_page_index(self):
+        """
+        Extracts the text blocks of every page once per document.
+        Returns a list (indexed by page number) of TextBlock lists that all section searches and crops share.
+        Loaded from the layout index when the splitter was given one.
+        """
+        if self.page_index is None and self.layout_index_path is not None:
+            with self.metrics.timer("layout_index"):
+                layout_index = LayoutIndex(self.layout_index_path)
+                self.page_index = layout_index.page_index()
+                layout_index.close()
+        if self.page_index is None:
+            self.page_index = []
+            for page_number in range(len(self.pdf_document)):
+                page = self.pdf_document.load_page(page_number)
+                with self.metrics.timer("get_text"):
+                    blocks = page.get_text("blocks")
+                self.page_index.append(to_text_blocks(page_number, blocks))
+        return self.page_index
+
+    def new_matcher(self, sections):
+        """BoundaryMatcher for sections with this splitter's settings"""
+        return BoundaryMatcher(sections, metrics=self.metrics, section_end=self.section_end,
+                               phrase_table=self.phrase_table)
+
+    def section_folder(self):
+        """Folder the section PDFs of this document are saved in"""
+        return os.path.join(self.output_folder, self.document_name)
+
     def extract_text_with_coords(self, page):
         """
         Extracts text blocks and their coordinates from a PDF page.
         """
-        text_instances = []
-        blocks = page.get_text("blocks")
-        #print(f"Extracted {len(blocks)} blocks on page {page.number}")
-       
-        for block in blocks:
-            block_text, block_rect = block[4], block[:4]
-            if block_text.strip():
-                text_instances.append((block_text, block_rect))
-                #print(f"Text: {block_text.strip()}, Coords: {block_rect}")
-        return text_instances
+        return [(block.text, block.rect) for block in self.build_page_index()[page.number]]
  
     def find_exact_match(self, text, target_texts):
-        """Search for an exact match in the list of target texts"""
-        return any(target_text in text for target_text in target_texts)
+        """Search for an exact match in the list of target texts, both compared in their normalize_phrase form"""
+        normalized_text = normalize_phrase(text)
+        normalized_targets = self.phrase_table.normalized
+        if any(normalized_targets[phrase_id] in normalized_text for phrase_id in self.phrase_table.intern(target_texts)):
+            self.metrics.count("exact_matches")
+            return True
+        return False
  
-    def find_fuzzy_match(self, text, target_texts, threshold=90):
-        """Search for fuzzy match (used if exact match not found)"""
+    def find_fuzzy_match(self, text, target_texts, threshold=90, normalized_text=None):
+        """
+        Search for fuzzy match (used if exact match not found) - normalized_text is the precomputed text.lower()
+        Targets are looked up in the phrase table; duplicates and targets whose length or characters can't reach
+        the threshold are skipped before running fuzz.ratio.
+        """
+        if normalized_text is None:
+            normalized_text = text.lower()
+        intern = self.phrase_table.intern
+        compared = set()
         for target_text in target_texts:
-            ratio = fuzz.ratio(target_text.lower(), text.lower())
+            phrase_id = self.phrase_table.lowered_ids[intern([target_text])[0]]
+            if phrase_id in compared:
+                continue  # Same lowered text as a target that already didn't match
+            compared.add(phrase_id)
+            target_lowered = self.phrase_table.lowered[phrase_id]
+            if not could_reach_ratio(target_lowered, normalized_text, threshold):
+                continue
+            ratio = fuzz_ratio(target_lowered, normalized_text)
  
             if ratio >= threshold:
-                print(f"Fuzzy match found with score {ratio}: {text} -> {target_text}")
+                self.metrics.count("fuzzy_matches")
+                self.metrics.log("Fuzzy match found with score %s: %s -> %s", ratio, text, target_text)
                 return True
         return False
  
     def find_section_ranges(self, start_texts_with_multiple_ends):
-        total_pages = len(self.pdf_document)
         ranges = []
-   
-        for start_texts, end_texts in start_texts_with_multiple_ends:
-            start_page = None
-            end_page = None
-            potential_end_page = None  # Track if we hit "Reserved for Future Use" but don't act on it immediately
+        page_index = self.build_page_index()
+        with self.metrics.timer("matching"):
+            for start_texts, end_texts in start_texts_with_multiple_ends:
+                start_page = None
+                end_page = None
+                potential_end_page = None  # Track if we hit "Reserved for Future Use" but don't act on it immediately
            
-            #go through each page, checking extracted text for matches with each phrase (trying exact, then fuzzy matching for more accuracy)
-            for page_number in range(total_pages):
-                page = self.pdf_document.load_page(page_number)
-                text_blocks = self.extract_text_with_coords(page)
- 
-                for text, _ in text_blocks:
-                    if start_page is None and self.find_exact_match(text, start_texts):
-                        start_page = page_number
-                        print(f"Found exact start text on page {start_page}")
+                #go through each page, checking extracted text for matches with each phrase (trying exact, then fuzzy matching for more accuracy)
+                for page_number, text_blocks in enumerate(page_index):
+                    for _, text, _, normalized_text in text_blocks:
+                        if start_page is None and self.find_exact_match(text, start_texts):
+                            start_page = page_number
+                            self.metrics.log("Found exact start text on page %s", start_page)
  
-                    elif start_page is None and self.find_fuzzy_match(text, start_texts):
-                        start_page = page_number
-                        print(f"Fuzzy matched start text on page {start_page}")
+                        elif start_page is None and self.find_fuzzy_match(text, start_texts, normalized_text=normalized_text):
+                            start_page = page_number
+                            self.metrics.log("Fuzzy matched start text on page %s", start_page)
                    
-                    if start_page is not None:
-                        # If we find a "Reserved for Future Use", mark this as potential end but continue looking
-                        if self.find_exact_match(text, ["Reserved for Future Use"]):
-                            potential_end_page = page_number
-                            print(f"Found potential 'Reserved for Future Use' on page {potential_end_page}")
+                        if start_page is not None:
+                            # If we find a "Reserved for Future Use", mark this as potential end but continue looking
+                            if self.find_exact_match(text, ["Reserved for Future Use"]):
+                                potential_end_page = page_number
+                                self.metrics.log("Found potential 'Reserved for Future Use' on page %s", potential_end_page)
                        
-                        # If we find a new section, stop at that instead of "Reserved for Future Use"
-                        if self.find_exact_match(text, end_texts):
-                            end_page = page_number
-                            print(f"Found exact end text on page {end_page}")
-                            break
-                        elif self.find_fuzzy_match(text, end_texts):
-                            end_page = page_number
-                            print(f"Fuzzy matched end text on page {end_page}")
-                            break
+                            # If we find a new section, stop at that instead of "Reserved for Future Use"
+                            if self.find_exact_match(text, end_texts):
+                                end_page = page_number
+                                self.metrics.log("Found exact end text on page %s", end_page)
+                                break
+                            elif self.find_fuzzy_match(text, end_texts, normalized_text=normalized_text):
+                                end_page = page_number
+                                self.metrics.log("Fuzzy matched end text on page %s", end_page)
+                                break
            
-            if start_page is not None and (end_page is not None or potential_end_page is not None):
-                # Use the actual end if found, or fallback to "Reserved for Future Use"
-                final_end_page = end_page if end_page is not None else potential_end_page
-                if start_page <= final_end_page:
-                    ranges.append((start_texts, start_page, final_end_page))
-            else:
-                print(f"Could not find valid range for start '{start_texts}' and end texts {end_texts}")
+                if start_page is not None and (end_page is not None or potential_end_page is not None):
+                    # Use the actual end if found, or fallback to "Reserved for Future Use"
+                    final_end_page = end_page if end_page is not None else potential_end_page
+                    if start_page <= final_end_page:
+                        ranges.append((start_texts, start_page, final_end_page))
+                else:
+                    self.metrics.log("Could not find valid range for start '%s' and end texts %s", start_texts, end_texts)
         return ranges
  
-    def crop_page(self, page, start_texts, end_texts):
+    def find_all_section_ranges(self, sections, matcher=None):
         """
-        Crops a page from the first found start_text to the first found end_text.
+        Finds the ranges of every section in one pass over the document.
+
+        :param sections: Dict of section name -> list of (start_texts, end_texts).
+        :param matcher: BoundaryMatcher built for sections (built here if None) - pass one in to reuse its block matches.
+        :return: Dict of section name -> list of (start_texts, start_page, end_page), same as find_section_ranges.
         """
-        text_instances = self.extract_text_with_coords(page)
+        page_index = self.build_page_index()
+        with self.metrics.timer("matching"):
+            if matcher is None:
+                matcher = self.new_matcher(sections)
+            if self.section_search == "ordered":
+                all_ranges = matcher.find_ordered_section_ranges(page_index)
+            else:
+                all_ranges = matcher.find_section_ranges(page_index)
+        for name, ranges in all_ranges.items():
+            for _, start_page, end_page in ranges:
+                self.metrics.log(f"Found section '{name}' on pages {start_page} - {end_page}")
+        return all_ranges
+ 
+    def find_crop_rect(self, page, start_texts, end_texts):
+        """
+        Finds the rect of a page from the first found start_text to the first found end_text (None if no match).
+        """
+        text_instances = self.build_page_index()[page.number]
+        with self.metrics.timer("matching"):
+            return self.match_crop_rect(text_instances, start_texts, end_texts)
+
+    def match_crop_rect(self, text_instances, start_texts, end_texts):
         crop_boxes = []
         cropping = False
        
-        for text, rect in text_instances:
+        for _, text, rect, normalized_text in text_instances:
             # Try exact match first
             if self.find_exact_match(text, start_texts):
                 cropping = True
                 crop_boxes.append(rect)
             # Fuzzy match fallback for start_texts
-            elif self.find_fuzzy_match(text, start_texts):
+            elif self.find_fuzzy_match(text, start_texts, normalized_text=normalized_text):
                 cropping = True
                 crop_boxes.append(rect)
  
@@ -379,7 +1852,7 @@ class SplitPdf:
                 crop_boxes.append(rect)
                 break
             # Fuzzy match fallback for end_texts
-            elif self.find_fuzzy_match(text, end_texts):
+            elif self.find_fuzzy_match(text, end_texts, normalized_text=normalized_text):
                 cropping = False
                 crop_boxes.append(rect)
                 break
@@ -392,8 +1865,48 @@ class SplitPdf:
         max_x = max(box[2] for box in crop_boxes)
         max_y = max(box[3] for box in crop_boxes)
        
-        pix = page.get_pixmap(clip=fitz.Rect(min_x, min_y, max_x, max_y))
-        return pix
+        return fitz.Rect(min_x, min_y, max_x, max_y)
+ 
+    def crop_page(self, page, start_texts, end_texts):
+        """
+        Crops a page from the first found start_text to the first found end_text into a pixmap (raster crop mode).
+        """
+        rect = self.find_crop_rect(page, start_texts, end_texts)
+        if rect is None:
+            return None  # Return None if no crop boxes were found
+        return page.get_pixmap(clip=rect)
+ 
+    def add_cropped_page(self, output_pdf, page, start_texts, end_texts):
+        """
+        Adds the cropped part of page to output_pdf. Returns False if the page could not be cropped.
+
+        vector: the page content is placed clipped to the crop rect, so text stays selectable and nothing is rasterized.
+        raster: the crop is rendered to a pixmap and inserted as an image.
+        """
+        rect = self.find_crop_rect(page, start_texts, end_texts)
+        if rect is None or rect.is_empty:
+            return False
+        self.add_crop(output_pdf, page, rect)
+        return True
+
+    def add_crop(self, output_pdf, page, rect, pixmaps=None):
+        """
+        Adds rect of page as a new page of output_pdf.
+        pixmaps (raster mode) is a dict of crops already rendered from this page, shared by the parts that need them.
+        """
+        with self.metrics.timer("crop"):
+            if self.crop_mode == "raster":
+                key = tuple(rect)
+                cropped_pixmap = pixmaps.get(key) if pixmaps is not None else None
+                if cropped_pixmap is None:
+                    cropped_pixmap = page.get_pixmap(clip=rect)
+                    if pixmaps is not None:
+                        pixmaps[key] = cropped_pixmap
+                new_page = output_pdf.new_page(width=cropped_pixmap.width, height=cropped_pixmap.height)
+                new_page.insert_image(new_page.rect, pixmap=cropped_pixmap)
+            else:
+                new_page = output_pdf.new_page(width=rect.width, height=rect.height)
+                new_page.show_pdf_page(new_page.rect, self.pdf_document, page.number, clip=rect)
  
     def save_cropped_section(self, part_number, start_page, end_page, start_texts, output_folder, end_texts):
         """
@@ -403,33 +1916,30 @@ class SplitPdf:
  
         for page_number in range(start_page, end_page + 1):
             page = self.pdf_document.load_page(page_number)
-            cropped_pixmap = self.crop_page(page, start_texts, end_texts)
-            if cropped_pixmap:
-                new_page = output_pdf.new_page(width=cropped_pixmap.width, height=cropped_pixmap.height)
-                new_page.insert_image(new_page.rect, pixmap=cropped_pixmap)
-                cropped_pixmap = None  # Release memory immediately
-            else:
-                print(f"Could not crop page {page_number} due to missing text match.")
+            if not self.add_cropped_page(output_pdf, page, start_texts, end_texts):
+                self.metrics.log(f"Could not crop page {page_number} due to missing text match.")
        
         if len(output_pdf) > 0:
             section_filename = f"{part_number}.pdf"
             section_path = os.path.join(output_folder, section_filename)
-            output_pdf.save(section_path)
+            with self.metrics.timer("save"):
+                output_pdf.save(section_path)
             output_pdf.close()
-            print(f"Section saved: {section_filename}")
+            self.metrics.log(f"Section saved: {section_filename}")
         else:
-            print(f"Warning: Section 'Part_{part_number}' has no pages to save.")
+            self.metrics.log(f"Warning: Section 'Part_{part_number}' has no pages to save.")
  
  
     """ MAIN CLASS - USE THIS TO ABSTRACT FUNCTIONALITY OF THE OTHERS """
-    def split_pdf_by_section_ranges(self, addition_to_output_folder, start_texts_with_multiple_ends):
+    def split_pdf_by_section_ranges(self, addition_to_output_folder, start_texts_with_multiple_ends, ranges=None):
         # Ensure the output folder exists
-        output_folder_path = os.path.join(self.output_folder, self.pdf_document.name)
+        output_folder_path = self.section_folder()
         if not os.path.exists(output_folder_path):
             os.makedirs(output_folder_path)
        
-        # Find pages for each start and end section
-        ranges = self.find_section_ranges(start_texts_with_multiple_ends)
+        # Find pages for each start and end section (unless already found with find_all_section_ranges)
+        if ranges is None:
+            ranges = self.find_section_ranges(start_texts_with_multiple_ends)
        
         part_number = 0
         for start_texts, start_page, end_page in ranges:
@@ -438,72 +1948,664 @@ class SplitPdf:
             part_number += 1
  
         #self.pdf_document.close()
+
+    def plan_sections(self, sections, matcher=None, section_ranges=None):
+        """
+        Plans every section's output pages and crop rects in one traversal of the document.
+        Each page's blocks are parsed and matched once and shared by every section that includes the page.
+
+        :param sections: Dict of section name -> list of (start_texts, end_texts).
+        :param matcher: BoundaryMatcher built for sections (built here if None).
+        :param section_ranges: Result of find_all_section_ranges (found here if None).
+        :return: Dict of section name -> list of (page_number, crop rect) in output order.
+        """
+        if matcher is None:
+            matcher = self.new_matcher(sections)
+        page_index = self.build_page_index()
+        if section_ranges is None:
+            with self.metrics.timer("matching"):
+                section_ranges = matcher.find_section_ranges(page_index)
+
+        # page number -> (section name, start ids, end ids) of every section that includes the page
+        sections_on_page = defaultdict(list)
+        for name, ranges in section_ranges.items():
+            for entry_number, (start_texts, start_page, end_page) in enumerate(ranges):
+                end_texts = sections[name][entry_number][1]  # Same pairing as split_pdf_by_section_ranges
+                for page_number in range(start_page, end_page + 1):
+                    sections_on_page[page_number].append((name, matcher.ids_of(start_texts), matcher.ids_of(end_texts)))
+
+        plan = {name: [] for name in sections}
+        with self.metrics.timer("matching"):
+            for page_number in sorted(sections_on_page):
+                for name, start_ids, end_ids in sections_on_page[page_number]:
+                    rect = matcher.find_crop_rect(page_index[page_number], start_ids, end_ids)
+                    if rect is None or rect.is_empty:
+                        self.metrics.log(f"Could not crop page {page_number} of '{name}' due to missing text match.")
+                        continue
+                    plan[name].append((page_number, rect))
+        return plan
+
+    def split_all_sections(self, sections, matcher=None, section_ranges=None):
+        """
+        Splits every section in one pass - ranges and crops are planned in a single traversal, then the pages are
+        walked once adding each page's crops to every part that includes it, and each part is written once.
+        Crops shared by overlapping parts (e.g. Part 2/Part 3) are only rendered once.
+        With save_workers > 1 the parts are built and written by a pool of worker processes instead.
+
+        :param sections: Dict of section name (output file name) -> list of (start_texts, end_texts).
+        :param matcher: BoundaryMatcher built for sections (built here if None).
+        :param section_ranges: Result of find_all_section_ranges (found here if None).
+        :return: The plan from plan_sections.
+        """
+        output_folder_path = self.section_folder()
+        os.makedirs(output_folder_path, exist_ok=True)
+
+        if matcher is None:
+            matcher = self.new_matcher(sections)
+        if section_ranges is None:
+            section_ranges = self.find_all_section_ranges(sections, matcher)
+        plan = self.plan_sections(sections, matcher, section_ranges)
+        self.save_planned_sections(plan, output_folder_path)
+        return plan
+
+    def save_planned_sections(self, plan, output_folder_path):
+        """
+        Builds and writes the parts of a plan_sections plan, each part written once.
+
+        :param plan: Dict of section name -> list of (page_number, crop rect) from plan_sections.
+        :param output_folder_path: Folder the part PDFs are written to.
+        """
+        # Workers reopen the document from disk, an in-memory document (streaming run) is written serially
+        if self.save_workers > 1 and self.pdf_document.name and sum(1 for pages in plan.values() if pages) > 1:
+            self.save_sections_parallel(plan, output_folder_path)
+            return
+
+        crops_on_page = defaultdict(list)
+        for name, planned_pages in plan.items():
+            for page_number, rect in planned_pages:
+                crops_on_page[page_number].append((name, rect))
+
+        output_pdfs = {name: fitz.open() for name, planned_pages in plan.items() if planned_pages}
+        for page_number in sorted(crops_on_page):
+            page = self.pdf_document.load_page(page_number)
+            pixmaps = {}  # Crops of this page rendered so far, reused by parts with the same rect
+            for name, rect in crops_on_page[page_number]:
+                self.add_crop(output_pdfs[name], page, rect, pixmaps)
+
+        for name in plan:
+            if name not in output_pdfs:
+                self.metrics.log(f"Warning: Section 'Part_{name}' has no pages to save.")
+                continue
+            section_filename = f"{name}.pdf"
+            with self.metrics.timer("save"):
+                output_pdfs[name].save(os.path.join(output_folder_path, section_filename))
+            output_pdfs[name].close()
+            self.metrics.log(f"Section saved: {section_filename}")
+
+    def save_sections_parallel(self, plan, output_folder_path):
+        """
+        Writes each planned part from a pool of at most save_workers processes, each with its own fitz handle.
+        Parts are submitted largest first and reported in section order; filenames are the same as the serial path.
+
+        :param plan: Dict of section name -> list of (page_number, crop rect) from plan_sections.
+        :param output_folder_path: Folder the part PDFs are written to.
+        """
+        parts = [name for name, planned_pages in plan.items() if planned_pages]
+        workers = min(self.save_workers, len(parts))
+        self.metrics.log(f"Writing {len(parts)} sections using {workers} worker processes...")
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for name in sorted(parts, key=lambda name: len(plan[name]), reverse=True):
+                planned_pages = [(page_number, tuple(rect)) for page_number, rect in plan[name]]
+                futures[name] = executor.submit(save_section_worker, self.pdf_document.name, self.crop_mode,
+                                                planned_pages, os.path.join(output_folder_path, f"{name}.pdf"))
+            for name in plan:
+                if name not in futures:
+                    self.metrics.log(f"Warning: Section 'Part_{name}' has no pages to save.")
+                    continue
+                self.metrics.merge(futures[name].result())
+                self.metrics.log(f"Section saved: {name}.pdf")
  
  
 
 
 
-"""" Script execution instructions: 
+""" Streaming version of the ExtractPdf + SplitPdf pipeline for one document"""
+def streaming_conflicts(header_scan=False, section_search="independent", chunk_size=None):
+    """The options given that the streaming pipeline can't apply (empty if it can run with all of them)"""
+    conflicts = []
+    if header_scan:
+        conflicts.append("header scan (it OCRs only the pages of the selected parts, not a stream of every page)")
+    if section_search != "independent":
+        conflicts.append(f"section_search '{section_search}' (the streaming scan is independent per section)")
+    if chunk_size:
+        conflicts.append("chunk_size (the streamed document stays in memory while it is split)")
+    return conflicts
 
-argument 1: scanned pdf path 
-argument 2: output folder
-argument 3: ocr output name
-"""
 
-def main():
-    if len(sys.argv) < 1:
-        print("Usage: python pdfprocessor.py <scanned_pdf_path>")
-        print("Example: python pdfprocessor.py 'path/to/scanned.pdf'")
-        sys.exit(1)
+class StreamingPipeline:
+    """
+    Runs the extract and split stages overlapped instead of one after another:
+    render (main thread) -> OCR (thread pool running tesseract) -> assemble, block extraction and boundary detection
+    (main thread) -> each section is split as soon as its range is final.
 
-    # Arguments
-    scanned_pdf_path = sys.argv[1]
-    output_folder = "output"
-    ocr_output_name = os.path.splitext(os.path.basename(scanned_pdf_path))[0] + "_EXTRACTED"
+    PyMuPDF isn't thread safe, so every fitz call stays on the main thread and the OCR threads only hand already
+    encoded page images to tesseract. At most queue_size pages are rendered ahead of the page being assembled.
+    The _EXTRACTED.pdf/.txt outputs, their fingerprints and the section PDFs are the same as the staged pipeline's.
+    With section_end "last" a range can still grow until the last page, so the parts are written at the end;
+    with "first" each part is written as soon as its end page has been assembled.
+    """
+    def __init__(self, extractor, crop_mode="vector", split_options=None, queue_size=None):
+        """
+        :param extractor: ExtractPdf with the document and OCR settings (chunk_size can't be used - the document
+                          being assembled stays in memory so it can be split while it grows).
+        :param crop_mode: SplitPdf crop mode.
+        :param split_options: Other SplitPdf options (section_end, ...). section_search "ordered" can't be used - the
+                              streaming scan is always independent per section.
+        :param queue_size: Pages rendered ahead of assembly (default: twice the OCR threads).
+        """
+        conflicts = streaming_conflicts(chunk_size=extractor.chunk_size,
+                                        section_search=(split_options or {}).get("section_search", "independent"))
+        if conflicts:
+            raise ValueError(f"Can't stream with {', '.join(conflicts)}")
+        self.extractor = extractor
+        self.metrics = extractor.metrics
+        self.crop_mode = crop_mode
+        self.split_options = split_options or {}
+        self.queue_size = queue_size or 2 * extractor.workers
 
-    # Check if the scanned PDF exists
-    if not os.path.isfile(scanned_pdf_path):
-        print(f"Error: The scanned PDF '{scanned_pdf_path}' does not exist.")
-        sys.exit(1)
+    def run(self, fingerprint):
+        """
+        Build the OCR PDF, its text file and every section PDF in one streaming pass.
 
+        :param fingerprint: The extractor's source_fingerprint(), recorded for the OCR PDF.
+        :return: Number of pages in the extracted PDF.
+        """
+        extractor = self.extractor
+        self.metrics.log("Extracting and splitting PDF as a stream...")
+        if self.split_options.get("section_end", "last") == "last":
+            self.metrics.log("Warning: with section_end 'last' a section can end on any later page, so every part is "
+                             "written after the last page - section_end 'first' writes each part as soon as it ends "
+                             "(its ranges can be shorter)")
+        started = time.perf_counter()
+        counters_before = dict(self.metrics.counters)
+        extractor.invalidate_ocr_pdf()
 
-    # Create an instance of the PDF extractor
-    pdf_extractor = ExtractPdf(scanned_pdf_path, output_folder, ocr_output_name, poppler_path)
+        scanned_doc = fitz.open(extractor.scanned_pdf_path)
+        ocr_doc = fitz.open()
+        try:
+            splitter = SplitPdf(ocr_doc, extractor.output_folder, self.crop_mode, self.metrics,
+                                document_name=extractor.ocr_pdf_path, **self.split_options)
+            sections = splitter.selected_sections()
+            matcher = splitter.new_matcher(sections)
+            scan = SectionScan(matcher)
+            splitter.page_index = []  # Filled page by page as the pages are assembled
+            os.makedirs(splitter.section_folder(), exist_ok=True)
+            written = []
+
+            with open(extractor.output_text_path, 'w', encoding='utf-8') as text_file, \
+                    ThreadPoolExecutor(max_workers=extractor.workers) as executor:
+                for page_number, ocr_result in self.ocr_results(scanned_doc, executor):
+                    extractor.add_page(ocr_doc, scanned_doc, page_number, ocr_result)
+                    with self.metrics.timer("get_text"):
+                        blocks = ocr_doc.load_page(page_number).get_text("blocks")
+
+                    text_file.write(f"\n--- Page {page_number + 1} ---\n")
+                    for block in blocks:
+                        text_file.write(block[4].strip() + "\n")
+
+                    splitter.page_index.append(to_text_blocks(page_number, blocks))
+                    with self.metrics.timer("matching"):
+                        final_sections = scan.feed(page_number, splitter.page_index[page_number])
+                    if final_sections:
+                        self.write_sections(splitter, sections, matcher, scan, final_sections)
+                        if not written:
+                            self.metrics.log(f"First section written after {time.perf_counter() - started:.1f}s")
+                        written += final_sections
+
+            # Every page is in, so the rest of the ranges are final
+            self.write_sections(splitter, sections, matcher, scan, [name for name in sections if name not in written])
+
+            temp_path = f"{extractor.ocr_pdf_path}.tmp"
+            with self.metrics.timer("save"):
+                ocr_doc.save(temp_path)
+            os.replace(temp_path, extractor.ocr_pdf_path)
+            extractor.write_fingerprint(extractor.ocr_fingerprint_path, fingerprint)
+            ocr_pdf_fingerprint = file_sha256(extractor.ocr_pdf_path)
+            extractor.write_fingerprint(extractor.text_fingerprint_path, ocr_pdf_fingerprint)
+            extractor.write_layout_index(splitter.page_index, ocr_pdf_fingerprint)
+            self.metrics.log(f"OCR PDF saved as: {extractor.ocr_pdf_path}")
+            extractor.log_page_counts(counters_before)
+            if extractor.adaptive_dpi is not None:
+                extractor.write_dpi_report()
+            return len(ocr_doc)
+        finally:
+            scanned_doc.close()
+            ocr_doc.close()
 
+    def ocr_results(self, scanned_doc, executor):
+        """
+        Yield (page_number, OCR'd PDF bytes or None for a page with a text layer) in page order, like
+        ExtractPdf.ocr_pages, while up to queue_size later pages are rendered and OCR'd in the background.
+        In adaptive mode a page below min_confidence is rendered and OCR'd again at full dpi when it is collected.
+        """
+        extractor = self.extractor
+        pending = deque()  # (page_number, known OCR result, OCR future, cache key) in page order
+        next_page = 0
+        while next_page < len(scanned_doc) or pending:
+            while next_page < len(scanned_doc) and len(pending) < self.queue_size:
+                pending.append((next_page,) + self.submit_page(scanned_doc.load_page(next_page), executor))
+                next_page += 1
+
+            page_number, ocr_result, future, cache_key = pending.popleft()
+            if future is not None:
+                ocr_result = future.result()
+                if cache_key is not None:
+                    extractor.cache.put(cache_key, pack_confidence(*ocr_result) if extractor.adaptive_dpi is not None
+                                        else ocr_result)
+            if ocr_result is not None:
+                extractor.page_dpis[page_number] = extractor.adaptive_dpi or extractor.dpi
+                if extractor.adaptive_dpi is not None:
+                    ocr_result, confidence = ocr_result
+                    if extractor.needs_reocr(page_number, confidence):
+                        ocr_result, _ = extractor.ocr_page_at(scanned_doc.load_page(page_number), extractor.dpi)
+                        extractor.page_dpis[page_number] = extractor.dpi
+            yield page_number, ocr_result
+
+    def submit_page(self, page, executor):
+        """
+        Render stage - renders and encodes page for OCR and submits it to the OCR threads.
+        Adaptive mode renders at adaptive_dpi and the OCR result comes with its confidence.
+
+        :return: (known OCR result, OCR future, cache key) - no future for cached pages or pages with a text layer.
+        """
+        extractor = self.extractor
+        if not extractor.is_selected(page.number):
+            self.metrics.count("pages_not_selected")
+            return None, None, None
+        if extractor.skip_text_pages and has_text_layer(page):
+            self.metrics.count("pages_text_layer")
+            return None, None, None
+
+        self.metrics.count("pages_ocr")
+        adaptive = extractor.adaptive_dpi is not None
+        dpi = extractor.adaptive_dpi if adaptive else extractor.dpi
+        with self.metrics.timer("render"):
+            pix = render_page(page, dpi, extractor.grayscale)
+        cache_key = None
+        if extractor.cache is not None:
+            cache_key = extractor.cache.key(pix, extractor.ocr_settings(dpi) + (";confidence" if adaptive else ""))
+            ocr_result = extractor.cache.get(cache_key)
+            if ocr_result is not None:
+                self.metrics.count("ocr_cache_hits")
+                return (unpack_confidence(ocr_result) if adaptive else ocr_result), None, None
+
+        with self.metrics.timer("render"):
+            image_bytes = extractor.encode_for_ocr(pix)
+        if adaptive:
+            return None, executor.submit(extractor.ocr_image_with_confidence, image_bytes, dpi), cache_key
+        return None, executor.submit(self.ocr_image, image_bytes), cache_key
+
+    def ocr_image(self, image_bytes):
+        """OCR stage - runs on an OCR thread"""
+        with self.metrics.timer("ocr"):
+            return self.extractor.ocr_encoded(image_bytes)
+
+    def write_sections(self, splitter, sections, matcher, scan, names):
+        """Plan and write the section PDFs of names, whose ranges are final"""
+        section_ranges = {name: scan.section_ranges(name) for name in names}
+        for name, ranges in section_ranges.items():
+            for _, start_page, end_page in ranges:
+                self.metrics.log(f"Found section '{name}' on pages {start_page} - {end_page}")
+        plan = splitter.plan_sections({name: sections[name] for name in names}, matcher, section_ranges)
+        splitter.save_planned_sections(plan, splitter.section_folder())
+
+
+"""" Script execution instructions: 
+
+argument 1: scanned pdf path (or with --batch: a directory, a glob pattern or a manifest file with one pdf path per line)
+--workers: number of OCR worker processes per document, also the tesseract runs at once of --header-scan (default 1)
+--crop-mode: vector (selectable text) or raster (image) section pages (default vector)
+--split-workers: number of processes writing section PDFs per document (default 1)
+--section-end: end a section on the last (default) or first page with one of its end texts
+--section-search: search sections independently (default) or in document order in one pass, each from where the
+                  previous one stopped
+--streaming: overlap rendering, OCR, text extraction and splitting instead of running them one after another
+             (parts are only written before the last page with --section-end first, which can shorten ranges)
+--parts: only split these sections, e.g. --parts "Part 2" "Part 3"
+--header-scan: find section pages from a low dpi OCR of bands of every page, then fully OCR only the pages of the
+               selected parts (every page when a selected part's end isn't in the bands). Parts whose start isn't in
+               the bands are taken as absent, and boundary texts outside the bands on pages that aren't fully OCR'd
+               are not seen
+--header-bands: the page height fractions --header-scan OCRs, e.g. 0:0.66 0.94:1 (the default)
+--cache-dir / --cache-size-mb / --no-cache: per-page OCR cache location and size cap
+--ocr-all-pages: OCR pages that already have a text layer too
+--ocr-handoff / --grayscale: how rendered pages are passed to tesseract
+--adaptive-dpi / --min-confidence: OCR at a lower dpi first and only redo low confidence pages at full dpi
+--chunk-size: stream the OCR PDF to disk in chunks of N pages (resumable)
+--quiet / --metrics-json: silence diagnostics, write stage timings and counters as JSON
+--batch: process many documents through a pool of --jobs worker processes
+
+Environment: PDFPROCESSOR_TESSERACT_CMD / PDFPROCESSOR_POPPLER_PATH override the tesseract executable and the Poppler
+folder (default: the Windows install folders on Windows, tesseract from the PATH elsewhere)
+"""
+
+def extract_for_split(pdf_extractor, output_folder, crop_mode, metrics, split_options):
+    """Bring the extracted PDF and its text up to date and return a SplitPdf over it"""
     # Extract PDF to text
     pdf_extractor.convert_scanned_to_text_pdf()
 
     # Get OCR text output to txt for checking
     pdf_extractor.extract_text_blocks()
-    
-    # Path to extracted PDF
-    extracted_pdf_path = pdf_extractor.ocr_pdf_path
 
-    # Create an instance of the PDF splitter
-    pdf_splitter = SplitPdf(extracted_pdf_path, output_folder)
+    # Create an instance of the PDF splitter over the extracted PDF
+    return SplitPdf(pdf_extractor.ocr_pdf_path, output_folder, crop_mode=crop_mode, metrics=metrics,
+                    layout_index_path=pdf_extractor.fresh_layout_index_path(), **split_options)
+
+
+def header_ranges_hold(pdf_splitter, sections, section_ranges, band_index, ocr_pages):
+    """
+    True if the header scan's section_ranges are unchanged when the band text of the fully OCR'd pages is replaced
+    by their full text - False means a start or end text outside the bands moves a boundary.
+    """
+    page_index = pdf_splitter.build_page_index()
+    pdf_splitter.page_index = [text_blocks if page_number in ocr_pages else band_index[page_number]
+                               for page_number, text_blocks in enumerate(page_index)]
+    try:
+        return pdf_splitter.find_all_section_ranges(sections) == section_ranges
+    finally:
+        pdf_splitter.page_index = page_index
+
+
+def process_document(scanned_pdf_path, output_folder="output", crop_mode="vector", metrics=None, split_options=None,
+                     streaming=False, header_scan=False, **extract_options):
+    """
+    Run the full extract + split pipeline for one scanned PDF.
+    extract_options are passed on to ExtractPdf (workers, dpi, cache_folder, ...).
+
+    :param metrics: Metrics shared by every stage of the run (a new one if None).
+    :param split_options: Options passed on to SplitPdf (save_workers, section_end, section_search, parts).
+    :param streaming: Run the stages overlapped with StreamingPipeline (unless the OCR PDF is already up to date).
+    :param header_scan: Find the section ranges from a low dpi OCR of bands of every page (extract option
+                        header_bands), then fully OCR just the pages of the selected parts (can't be combined with
+                        streaming). A section with no start text in the bands is taken as absent. Falls back to
+                        OCRing every page when a selected section's start is in the bands but not its end, or the full
+                        text of the selected pages changes a range. A boundary text outside the bands on a page that
+                        isn't fully OCR'd is not seen.
+    :return: Number of pages in the extracted PDF.
+    """
+    split_options = split_options or {}
+    if streaming:
+        conflicts = streaming_conflicts(header_scan, split_options.get("section_search", "independent"),
+                                        extract_options.get("chunk_size"))
+        if conflicts:
+            raise ValueError(f"Can't stream with {', '.join(conflicts)}")
+    if metrics is None:
+        metrics = Metrics()
+    ocr_output_name = os.path.splitext(os.path.basename(scanned_pdf_path))[0] + "_EXTRACTED"
+    os.makedirs(output_folder, exist_ok=True)
+
+    # Create an instance of the PDF extractor
+    pdf_extractor = ExtractPdf(scanned_pdf_path, output_folder, ocr_output_name, poppler_path, metrics=metrics,
+                               **extract_options)
+
+    section_ranges = None
+    if header_scan:
+        # Boundaries from the page bands, SplitPdf over the scanned document only supplies the section definitions
+        header_splitter = SplitPdf(scanned_pdf_path, output_folder, crop_mode=crop_mode, metrics=metrics, **split_options)
+        header_sections = header_splitter.selected_sections()
+        header_matcher = header_splitter.new_matcher(header_sections)
+        band_index = header_splitter.page_index = pdf_extractor.scan_headers()
+        section_ranges = header_splitter.find_all_section_ranges(header_sections, header_matcher)
+        header_splitter.pdf_document.close()
+        # A section without a start text in any band isn't in the document. One whose start is there but not its end
+        # (or the end comes first) has its end outside the bands - only the full page text can place it.
+        unplaced_sections, absent_sections = [], []
+        for name, ranges in section_ranges.items():
+            if not ranges:
+                (unplaced_sections if header_matcher.finds_start(band_index, name) else absent_sections).append(name)
+        if absent_sections:
+            metrics.log(f"Header scan: no start text of {', '.join(absent_sections)} in the page bands, "
+                        f"they aren't in this document")
+        if unplaced_sections:
+            metrics.log(f"Header scan: no end text of {', '.join(unplaced_sections)} in the page bands, OCRing every page")
+            section_ranges = None
+        else:
+            pdf_extractor.ocr_only_pages = {page_number for ranges in section_ranges.values()
+                                            for _, start_page, end_page in ranges
+                                            for page_number in range(start_page, end_page + 1)}
+            metrics.log(f"Header scan: {len(pdf_extractor.ocr_only_pages)} pages belong to the selected sections")
+    elif streaming:
+        fingerprint = pdf_extractor.source_fingerprint()
+        if not pdf_extractor.is_up_to_date(pdf_extractor.ocr_pdf_path, pdf_extractor.ocr_fingerprint_path, fingerprint):
+            return StreamingPipeline(pdf_extractor, crop_mode, split_options).run(fingerprint)
+
+    pdf_splitter = extract_for_split(pdf_extractor, output_folder, crop_mode, metrics, split_options)
 
     # Sections and corresponding folder names
-    sections = {
-        "K1": pdf_splitter.K1_form,
-        "K3 Title Page": pdf_splitter.K3_title_page,
-        "Part 1": pdf_splitter._1,
-        "Part 2": pdf_splitter._2,
-        "Part 3": pdf_splitter._3,
-        "Part 4": pdf_splitter._4,
-        "Part 5": pdf_splitter._5,
-        "Part 6": pdf_splitter._6,
-        "Part 7": pdf_splitter._7,
-        "Part 8": pdf_splitter._8,
-        "Part 9": pdf_splitter._9,
-        "Part 10": pdf_splitter._10,
-        "Part 11": pdf_splitter._11,
-        "Part 13": pdf_splitter._13
+    sections = pdf_splitter.selected_sections()
+
+    if section_ranges is not None and not header_ranges_hold(pdf_splitter, sections, section_ranges, band_index,
+                                                             pdf_extractor.ocr_only_pages):
+        metrics.log("Header scan: the full text of the selected pages moves a section boundary, OCRing every page")
+        pdf_splitter.pdf_document.close()
+        pdf_extractor.ocr_only_pages = None
+        section_ranges = None
+        pdf_splitter = extract_for_split(pdf_extractor, output_folder, crop_mode, metrics, split_options)
+
+    # Find every section's pages and crops in one pass over the document and write each part once
+    pdf_splitter.split_all_sections(sections, section_ranges=section_ranges)
+
+    page_count = len(pdf_splitter.pdf_document)
+    pdf_splitter.pdf_document.close()
+    return page_count
+
+
+def process_document_isolated(scanned_pdf_path, output_folder="output", crop_mode="vector", extract_options=None,
+                              quiet=False, split_options=None, streaming=False, header_scan=False):
+    """
+    Batch worker - runs process_document and reports failures instead of raising, so one bad document
+    doesn't stop the rest of the batch.
+    """
+    started = time.perf_counter()
+    metrics = Metrics(quiet)
+    try:
+        pages = process_document(scanned_pdf_path, output_folder, crop_mode, metrics, split_options, streaming,
+                                 header_scan, **(extract_options or {}))
+        error = None
+    except Exception as e:
+        pages = 0
+        error = f"{type(e).__name__}: {e}"
+    return {"path": scanned_pdf_path, "pages": pages, "seconds": time.perf_counter() - started, "error": error,
+            "metrics": metrics.as_dict()}
+
+
+def collect_batch_inputs(source):
+    """
+    Resolve a batch source to a list of pdf paths.
+
+    :param source: A directory (all *.pdf inside it), a manifest file (one pdf path per line, # for comments)
+                   or a glob pattern.
+    """
+    if os.path.isdir(source):
+        return sorted(glob.glob(os.path.join(source, "*.pdf")))
+    if os.path.isfile(source) and not source.lower().endswith(".pdf"):
+        manifest_folder = os.path.dirname(source)
+        with open(source, encoding='utf-8') as manifest:
+            paths = [line.strip() for line in manifest if line.strip() and not line.strip().startswith("#")]
+        # Relative paths in a manifest are relative to the manifest itself
+        return [path if os.path.isabs(path) else os.path.join(manifest_folder, path) for path in paths]
+    return sorted(glob.glob(source))
+
+
+def run_batch(pdf_paths, output_folder="output", jobs=1, crop_mode="vector", extract_options=None, quiet=False,
+              split_options=None, streaming=False, header_scan=False):
+    """
+    Process many documents through a bounded pool of worker processes.
+    At most `jobs` documents are in flight at once; failures are isolated per document and a throughput summary is printed.
+
+    :return: List of per-document result dicts (path, pages, seconds, error, metrics) in completion order.
+    """
+    jobs = max(1, jobs)
+    pending_paths = deque(pdf_paths)
+    results = []
+    started = time.perf_counter()
+
+    print(f"Batch: {len(pending_paths)} documents, {jobs} jobs")
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        in_flight = {}
+        while pending_paths or in_flight:
+            # Keep the queue bounded to one document per job
+            while pending_paths and len(in_flight) < jobs:
+                path = pending_paths.popleft()
+                in_flight[executor.submit(process_document_isolated, path, output_folder, crop_mode, extract_options,
+                                          quiet, split_options, streaming, header_scan)] = path
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:  # e.g. the worker process died
+                    result = {"path": path, "pages": 0, "seconds": 0.0, "error": f"{type(e).__name__}: {e}",
+                              "metrics": Metrics().as_dict()}
+                results.append(result)
+                status = "FAILED " + result["error"] if result["error"] else f"{result['pages']} pages"
+                print(f"[{len(results)}/{len(pdf_paths)}] {path}: {status} ({result['seconds']:.1f}s)")
+
+    elapsed = time.perf_counter() - started
+    succeeded = [result for result in results if not result["error"]]
+    total_pages = sum(result["pages"] for result in succeeded)
+    print(f"\nBatch finished in {elapsed:.1f}s: {len(succeeded)} succeeded, {len(results) - len(succeeded)} failed")
+    if elapsed > 0:
+        print(f"Throughput: {len(succeeded) / elapsed * 60:.2f} docs/min, {total_pages / elapsed:.2f} pages/sec")
+    for result in results:
+        if result["error"]:
+            print(f"Failed: {result['path']} - {result['error']}")
+    return results
+
+
+def header_band(value):
+    """argparse type of a --header-bands value - "top:bottom" page height fractions"""
+    try:
+        top, bottom = (float(fraction) for fraction in value.split(":"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected top:bottom fractions, got '{value}'")
+    if not 0 <= top < bottom <= 1:
+        raise argparse.ArgumentTypeError(f"expected 0 <= top < bottom <= 1, got '{value}'")
+    return top, bottom
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="OCR a scanned K-1/K-3 PDF and split it into sections.",
+                                     epilog="Example: python pdfprocessor.py 'path/to/scanned.pdf'")
+    parser.add_argument("scanned_pdf_path", help="Path to the scanned PDF (with --batch: directory, glob or manifest file)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of OCR worker processes per document, also the tesseract runs at once of "
+                             "--header-scan (default: 1)")
+    parser.add_argument("--crop-mode", choices=SplitPdf.CROP_MODES, default="vector",
+                        help="vector keeps section pages text-selectable, raster saves them as images (default: vector)")
+    parser.add_argument("--split-workers", type=int, default=1,
+                        help="Number of processes writing section PDFs per document (default: 1)")
+    parser.add_argument("--section-end", choices=BoundaryMatcher.SECTION_ENDS, default="last",
+                        help="End a section on the last or first page with one of its end texts (default: last)")
+    parser.add_argument("--section-search", choices=BoundaryMatcher.SECTION_SEARCHES, default="independent",
+                        help="ordered searches the sections in document order in one forward pass, each from where the "
+                             "previous section's search stopped up to its first end text or the start of a later "
+                             "section (default: independent)")
+    parser.add_argument("--parts", nargs="+", default=None,
+                        help='Only split these sections, e.g. --parts "Part 2" "Part 3" (default: every section)')
+    parser.add_argument("--header-scan", action="store_true",
+                        help="Find section pages from a low dpi OCR of bands of every page (--header-bands) and "
+                             "fully OCR only the pages of the selected parts. Boundary texts outside the bands are only "
+                             "seen on the fully OCR'd pages")
+    parser.add_argument("--header-bands", nargs="+", type=header_band, default=None, metavar="TOP:BOTTOM",
+                        help="Page height fractions --header-scan OCRs (default: "
+                             f"{' '.join(f'{top:g}:{bottom:g}' for top, bottom in ExtractPdf.HEADER_BANDS)})")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Overlap rendering, OCR, text extraction and splitting. Parts are written as soon as "
+                             "they end only with --section-end first (which can shorten ranges), else after the last page")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Directory of the per-page OCR cache (default: <output folder>/.ocr_cache)")
+    parser.add_argument("--cache-size-mb", type=int, default=1024, help="OCR cache size cap in MB (default: 1024)")
+    parser.add_argument("--no-cache", action="store_true", help="Don't cache per-page OCR results")
+    parser.add_argument("--ocr-all-pages", action="store_true",
+                        help="OCR every page, including pages that already have a text layer")
+    parser.add_argument("--ocr-handoff", choices=ExtractPdf.OCR_HANDOFFS, default="raw",
+                        help="raw streams page pixels straight to tesseract, png uses the PNG/pytesseract path (default: raw)")
+    parser.add_argument("--grayscale", action="store_true", help="Render pages in grayscale for OCR")
+    parser.add_argument("--adaptive-dpi", type=int, default=None,
+                        help="OCR pages at this lower dpi first and re-OCR pages below --min-confidence at 300 dpi")
+    parser.add_argument("--min-confidence", type=float, default=80,
+                        help="Mean tesseract word confidence (0-100) an adaptive first pass page needs (default: 80)")
+    parser.add_argument("--chunk-size", type=int, default=None,
+                        help="Write the OCR PDF to disk every N pages with bounded memory and resume support")
+    parser.add_argument("--quiet", action="store_true", help="Don't print per-page/per-match diagnostics")
+    parser.add_argument("--metrics-json", default=None, help="Write stage timings and counters to this JSON file")
+    parser.add_argument("--batch", action="store_true", help="Process a directory, glob or manifest of PDFs")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1,
+                        help="Number of documents processed at once in batch mode (default: CPU count)")
+    args = parser.parse_args(argv)
+    if args.header_bands and not args.header_scan:
+        parser.error("--header-bands only applies with --header-scan")
+    if args.streaming:
+        conflicts = streaming_conflicts(args.header_scan, args.section_search, args.chunk_size)
+        if conflicts:
+            parser.error(f"--streaming can't be combined with {', '.join(conflicts)}")
+    return args
+
+def main():
+    args = parse_args()
+    output_folder = "output"
+    extract_options = {
+        "workers": args.workers,
+        "cache_folder": None if args.no_cache else (args.cache_dir or os.path.join(output_folder, ".ocr_cache")),
+        "cache_max_bytes": args.cache_size_mb * 1024 * 1024,
+        "skip_text_pages": not args.ocr_all_pages,
+        "ocr_handoff": args.ocr_handoff,
+        "grayscale": args.grayscale,
+        "chunk_size": args.chunk_size,
+        "adaptive_dpi": args.adaptive_dpi,
+        "min_confidence": args.min_confidence,
+        "header_bands": args.header_bands,
     }
+    split_options = {"save_workers": args.split_workers, "section_end": args.section_end,
+                     "section_search": args.section_search, "parts": args.parts}
+
+    if args.batch:
+        pdf_paths = collect_batch_inputs(args.scanned_pdf_path)
+        if not pdf_paths:
+            print(f"Error: No PDFs found for '{args.scanned_pdf_path}'.")
+            sys.exit(1)
+        results = run_batch(pdf_paths, output_folder, args.jobs, args.crop_mode, extract_options, args.quiet,
+                            split_options, args.streaming, args.header_scan)
+        if args.metrics_json:
+            total_metrics = Metrics()
+            for result in results:
+                total_metrics.merge(result["metrics"])
+            with open(args.metrics_json, 'w', encoding='utf-8') as metrics_file:
+                json.dump({"total": total_metrics.as_dict(),
+                           "documents": {result["path"]: result["metrics"] for result in results}},
+                          metrics_file, indent=2, sort_keys=True)
+        sys.exit(1 if any(result["error"] for result in results) else 0)
+
+    # Arguments
+    scanned_pdf_path = args.scanned_pdf_path
 
-    # Split each section in the extracted PDF
-    for file_name_addition, start_end in sections.items():
-        print(f"\nStarting section '{file_name_addition}'...")
-        pdf_splitter.split_pdf_by_section_ranges(file_name_addition, start_end)
+    # Check if the scanned PDF exists
+    if not os.path.isfile(scanned_pdf_path):
+        print(f"Error: The scanned PDF '{scanned_pdf_path}' does not exist.")
+        sys.exit(1)
+
+    metrics = Metrics(args.quiet)
+    try:
+        process_document(scanned_pdf_path, output_folder, args.crop_mode, metrics, split_options, args.streaming,
+                         args.header_scan, **extract_options)
+    except Exception as e:
+        print(f"Error processing '{scanned_pdf_path}': {type(e).__name__}: {e}")
+        sys.exit(1)
+    if args.metrics_json:
+        metrics.write_json(args.metrics_json)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()